@@ -0,0 +1,103 @@
+"""Loudness and duration analysis of library files.
+
+Each track is decoded once by FFmpeg through the ``ebur128`` filter, which
+gives EBU R128 integrated loudness, loudness range and true peak, while the
+progress output gives the exact decoded duration. Results are written back as
+ReplayGain 2.0 tags (reference level -18 LUFS) so players can normalize
+playback without decoding the file themselves.
+"""
+import os
+import re
+import subprocess
+from pathlib import Path
+from typing import Dict, Optional
+
+import mutagen
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3, TXXX, TLEN
+from mutagen.mp3 import MP3
+
+from retag import id3_padding, path_lock
+
+REPLAYGAIN_REFERENCE = -18.0  # LUFS
+
+_INTEGRATED_RE = re.compile(r'^\s*I:\s*(-?[\d.]+|-inf)\s+LUFS', re.MULTILINE)
+_RANGE_RE = re.compile(r'^\s*LRA:\s*(-?[\d.]+)\s+LU\b', re.MULTILINE)
+_PEAK_RE = re.compile(r'^\s*Peak:\s*(-?[\d.]+|-inf)\s+dBFS', re.MULTILINE)
+_OUT_TIME_RE = re.compile(r'^out_time_us=(\d+)$', re.MULTILINE)
+
+
+def lower_priority():
+    """Process pool initializer: run analysis (and the FFmpeg it spawns) at idle priority"""
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+
+def _parse_level(value: str) -> Optional[float]:
+    return None if value == '-inf' else float(value)
+
+
+def analyze_file(path: str) -> Dict[str, Optional[float]]:
+    """Measure loudness, loudness range, true peak and exact duration in one FFmpeg pass"""
+    cmd = [
+        'ffmpeg', '-nostdin', '-hide_banner', '-nostats',
+        '-i', path,
+        '-map', '0:a:0',
+        '-filter:a', 'ebur128=peak=true:framelog=quiet',
+        '-progress', 'pipe:1',
+        '-f', 'null', '-',
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {result.stderr.strip()[-500:]}")
+
+    # The filter logs its summary last, so take the final match of each value
+    integrated = _INTEGRATED_RE.findall(result.stderr)
+    loudness_range = _RANGE_RE.findall(result.stderr)
+    peak = _PEAK_RE.findall(result.stderr)
+    out_time = _OUT_TIME_RE.findall(result.stdout)
+    if not integrated or not peak or not out_time:
+        raise RuntimeError("Could not parse FFmpeg loudness summary")
+
+    loudness = _parse_level(integrated[-1])
+    true_peak = _parse_level(peak[-1])
+    return {
+        'duration': int(out_time[-1]) / 1_000_000,
+        'loudness': loudness,
+        'loudness_range': float(loudness_range[-1]) if loudness_range else None,
+        'true_peak': true_peak,
+        # Silent tracks have no meaningful gain
+        'track_gain': round(REPLAYGAIN_REFERENCE - loudness, 2) if loudness is not None else None,
+        'track_peak': round(10 ** (true_peak / 20), 6) if true_peak is not None else None,
+    }
+
+
+def write_replaygain(path: Path, result: Dict[str, Optional[float]]) -> bool:
+    """Write ReplayGain and length tags; returns False for formats that are not tagged"""
+    gain = f"{result['track_gain']:+.2f} dB" if result['track_gain'] is not None else None
+    peak = f"{result['track_peak']:.6f}" if result['track_peak'] is not None else None
+
+    with path_lock(path):
+        audio = mutagen.File(str(path))
+        if isinstance(audio, MP3):
+            audio = MP3(str(path), ID3=ID3)
+            if audio.tags is None:
+                audio.add_tags()
+            for desc, value in (('REPLAYGAIN_TRACK_GAIN', gain), ('REPLAYGAIN_TRACK_PEAK', peak)):
+                audio.tags.delall(f'TXXX:{desc}')
+                if value is not None:
+                    audio.tags.add(TXXX(encoding=3, desc=desc, text=value))
+            audio.tags.setall('TLEN', [TLEN(encoding=3, text=str(int(result['duration'] * 1000)))])
+            audio.save(padding=id3_padding)
+            return True
+
+        if isinstance(audio, FLAC):
+            for key, value in (('replaygain_track_gain', gain), ('replaygain_track_peak', peak)):
+                if value is not None:
+                    audio[key] = value
+                elif key in audio:
+                    del audio[key]
+            audio.save(padding=id3_padding)
+            return True
+
+        return False
@@ -0,0 +1,386 @@
+"""Audio fingerprinting and near-duplicate lookup.
+
+Fingerprints follow the band-energy scheme of Haitsma & Kalker: a short
+window of the track is decoded to mono PCM at a low sample rate, split into
+heavily overlapping frames, and every frame is reduced to a 32-bit
+sub-fingerprint describing how the energy of 33 log-spaced bands changes
+across frequency and time. Two recordings of the same audio produce
+sub-fingerprints with a low bit error rate (BER), even after re-encoding.
+"""
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 5512
+FRAME_SIZE = 2048
+HOP_SIZE = 256
+NUM_BANDS = 33
+MIN_FREQ = 300.0
+MAX_FREQ = 2000.0
+
+# Decoded window: skip the first seconds (intros, silence) and keep enough
+# audio that re-uploads with a different lead-in still overlap
+WINDOW_OFFSET = 10.0
+WINDOW_DURATION = 40.0
+MAX_FRAMES = int((WINDOW_DURATION * SAMPLE_RATE - FRAME_SIZE) // HOP_SIZE) + 1
+
+# Matching parameters
+MATCH_THRESHOLD = 0.35  # BER below this means "same recording"
+MIN_OVERLAP_FRAMES = 128  # ~6 seconds of aligned audio
+MAX_CANDIDATES = 32
+
+# Tracks added since the lookup table was built are searched one by one until
+# this many have piled up, then their tables are merged into the main one
+MAX_UNINDEXED = 64
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_BIT_WEIGHTS = (1 << np.arange(NUM_BANDS - 1, dtype=np.uint64)).astype(np.uint64)
+_IGNORED_HASHES = np.array([0, 0xFFFFFFFF], dtype=np.uint32)
+
+
+def _band_matrix() -> np.ndarray:
+    """Return an (fft_bins, NUM_BANDS) matrix summing FFT power into log-spaced bands"""
+    freqs = np.fft.rfftfreq(FRAME_SIZE, d=1.0 / SAMPLE_RATE)
+    edges = np.geomspace(MIN_FREQ, MAX_FREQ, NUM_BANDS + 1)
+    band_of_bin = np.searchsorted(edges, freqs, side="right") - 1
+    matrix = np.zeros((freqs.size, NUM_BANDS), dtype=np.float32)
+    valid = (band_of_bin >= 0) & (band_of_bin < NUM_BANDS)
+    matrix[np.nonzero(valid)[0], band_of_bin[valid]] = 1.0
+    return matrix
+
+
+_BANDS = _band_matrix()
+_WINDOW = np.hanning(FRAME_SIZE).astype(np.float32)
+
+
+def decode_audio(source: str, offset: float = WINDOW_OFFSET, duration: float = WINDOW_DURATION,
+                 headers: Optional[Dict[str, str]] = None) -> np.ndarray:
+    """Decode a window of audio to mono float32 PCM at SAMPLE_RATE using FFmpeg
+
+    ``source`` can be a local path or a remote media URL.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error']
+    if headers:
+        cmd += ['-headers', ''.join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    cmd += [
+        '-ss', str(offset),
+        '-t', str(duration),
+        '-i', source,
+        '-vn',
+        '-ac', '1',
+        '-ar', str(SAMPLE_RATE),
+        '-f', 's16le',
+        '-',
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def compute_fingerprint(samples: np.ndarray) -> np.ndarray:
+    """Compute the uint32 sub-fingerprint sequence for mono PCM samples"""
+    if samples.size < FRAME_SIZE + HOP_SIZE:
+        return np.zeros(0, dtype=np.uint32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    frames = frames[:MAX_FRAMES + 1]
+    spectrum = np.fft.rfft(frames * _WINDOW, axis=1)
+    power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+    energy = power @ _BANDS
+
+    # Bit m of frame n is set when the energy difference between bands m and
+    # m+1 grows compared to the previous frame
+    band_diff = energy[:, :-1] - energy[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    return (bits.astype(np.uint64) @ _BIT_WEIGHTS).astype(np.uint32)
+
+
+def fingerprint_file(path: str) -> np.ndarray:
+    """Fingerprint a local audio file, falling back to its start for short tracks"""
+    samples = decode_audio(path)
+    if samples.size < FRAME_SIZE + MIN_OVERLAP_FRAMES * HOP_SIZE:
+        samples = decode_audio(path, offset=0.0)
+    return compute_fingerprint(samples)
+
+
+def bit_error_rate(a: np.ndarray, b: np.ndarray) -> float:
+    """Fraction of differing bits between two equally long sub-fingerprint sequences"""
+    if a.size == 0:
+        return 1.0
+    diff = np.bitwise_xor(a, b)
+    return float(_POPCOUNT8[diff.view(np.uint8)].sum()) / (a.size * 32)
+
+
+class FingerprintIndex:
+    """Array-backed store of library fingerprints with near-match lookup
+
+    Fingerprints live in a single (tracks, MAX_FRAMES) uint32 matrix. A sorted
+    copy of every sub-fingerprint with its owner and frame position acts as the
+    lookup table: exact sub-fingerprint hits vote for (track, time offset)
+    alignments, and the best alignments are verified by their bit error rate.
+    Tracks added after the table was built get a small table of their own
+    until enough of them accumulate to be merged into the main table. Batch
+    imports can defer indexing altogether and build the table once at the end.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._keys: List[str] = []
+        self._mtimes = np.zeros(0, dtype=np.float64)
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._matrix = np.zeros((0, MAX_FRAMES), dtype=np.uint32)
+        self._positions: Dict[str, int] = {}
+        self._table: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self._unindexed: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "FingerprintIndex":
+        """Load an index from disk, returning an empty one if it is missing or unreadable"""
+        index = cls(path)
+        if not path.exists():
+            return index
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                index._keys = [str(k) for k in data['keys']]
+                index._mtimes = data['mtimes'].astype(np.float64)
+                index._lengths = data['lengths'].astype(np.int32)
+                index._matrix = data['matrix'].astype(np.uint32)
+            index._positions = {key: i for i, key in enumerate(index._keys)}
+            logger.info(f"Loaded {len(index._keys)} audio fingerprints")
+        except Exception as e:
+            logger.error(f"Error loading fingerprint index: {e}")
+            return cls(path)
+        return index
+
+    def save(self):
+        """Atomically write the index next to its target path"""
+        if self.path is None:
+            return
+        with self._lock:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            count = len(self._keys)
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    keys=np.array(self._keys, dtype=str),
+                    mtimes=self._mtimes[:count],
+                    lengths=self._lengths[:count],
+                    matrix=self._matrix[:count],
+                )
+            os.replace(tmp_path, self.path)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def keys(self) -> List[str]:
+        """Return a snapshot of the indexed keys"""
+        with self._lock:
+            return list(self._keys)
+
+    def is_current(self, key: str, mtime: float) -> bool:
+        """Check whether ``key`` is indexed with the given modification time"""
+        with self._lock:
+            pos = self._positions.get(key)
+            return pos is not None and self._mtimes[pos] == mtime
+
+    def _grow(self):
+        """Double the capacity of the backing arrays"""
+        capacity = max(64, 2 * self._matrix.shape[0])
+        matrix = np.zeros((capacity, MAX_FRAMES), dtype=np.uint32)
+        matrix[:len(self._keys)] = self._matrix[:len(self._keys)]
+        self._matrix = matrix
+        self._lengths = np.resize(self._lengths, capacity)
+        self._mtimes = np.resize(self._mtimes, capacity)
+
+    def update_mtime(self, key: str, mtime: float):
+        """Record a new mtime for a file whose audio did not change (e.g. after retagging)"""
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is not None:
+                self._mtimes[pos] = mtime
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return a copy of the fingerprint stored under ``key``"""
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is None:
+                return None
+            return self._matrix[pos, :self._lengths[pos]].copy()
+
+    def add(self, key: str, fingerprint: np.ndarray, mtime: float = 0.0, defer_indexing: bool = False):
+        """Insert or replace the fingerprint stored under ``key``
+
+        With ``defer_indexing`` the fingerprint is stored but only found by
+        lookups after the next ``reindex()``.
+        """
+        length = min(fingerprint.size, MAX_FRAMES)
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is None:
+                pos = len(self._keys)
+                if pos == self._matrix.shape[0]:
+                    self._grow()
+                self._positions[key] = pos
+                self._keys.append(key)
+            self._mtimes[pos] = mtime
+            self._lengths[pos] = length
+            self._matrix[pos] = 0
+            self._matrix[pos, :length] = fingerprint[:length]
+            if self._table is None:
+                return
+            if defer_indexing:
+                self._unindexed.pop(pos, None)
+                return
+            # Stale table entries for a replaced row only add candidates
+            # that fail verification, so the table itself stays valid
+            self._unindexed[pos] = self._build_table(np.array([pos]))
+            if len(self._unindexed) > MAX_UNINDEXED:
+                self._merge_unindexed()
+
+    def reindex(self):
+        """Rebuild the lookup table over every stored fingerprint"""
+        with self._lock:
+            self._table = self._build_table(np.arange(len(self._keys)))
+            self._unindexed.clear()
+    
+    def remove(self, key: str):
+        """Drop ``key`` from the index if present"""
+        with self._lock:
+            pos = self._positions.pop(key, None)
+            if pos is None:
+                return
+            # Move the last entry into the freed slot to keep rows contiguous
+            last = len(self._keys) - 1
+            last_key = self._keys.pop()
+            if pos != last:
+                self._keys[pos] = last_key
+                self._positions[last_key] = pos
+                self._mtimes[pos] = self._mtimes[last]
+                self._lengths[pos] = self._lengths[last]
+                self._matrix[pos] = self._matrix[last]
+            self._table = None
+            self._unindexed.clear()
+    
+    def rename(self, old_key: str, new_key: str):
+        """Move a fingerprint to a new key, e.g. after the file was renamed"""
+        with self._lock:
+            if old_key not in self._positions or old_key == new_key:
+                return
+            self.remove(new_key)
+            pos = self._positions.pop(old_key)
+            self._keys[pos] = new_key
+            self._positions[new_key] = pos
+
+    def _build_table(self, tracks: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Build a sorted hash -> (track, frame) lookup table over the given rows"""
+        matrix = self._matrix[tracks]
+        frame_ids = np.arange(MAX_FRAMES, dtype=np.int32)
+        valid = frame_ids[None, :] < self._lengths[tracks, None]
+        valid &= ~np.isin(matrix, _IGNORED_HASHES)
+        rows, frames = np.nonzero(valid)
+        hashes = matrix[rows, frames]
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order], tracks[rows[order]].astype(np.int32), frames[order].astype(np.int32)
+
+    def _merge_unindexed(self):
+        """Merge the tables of unindexed tracks into the main lookup table"""
+        positions = np.fromiter(self._unindexed, dtype=np.int32, count=len(self._unindexed))
+        hashes, owners, frames = self._table
+        keep = ~np.isin(owners, positions)
+        tables = [(hashes[keep], owners[keep], frames[keep]), *self._unindexed.values()]
+        hashes = np.concatenate([table[0] for table in tables])
+        owners = np.concatenate([table[1] for table in tables])
+        frames = np.concatenate([table[2] for table in tables])
+        # Every part is already sorted, so the stable sort only merges runs
+        order = np.argsort(hashes, kind='stable')
+        self._table = (hashes[order], owners[order], frames[order])
+        self._unindexed.clear()
+
+    def _lookup_tables(self) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Return the main lookup table, building it if needed, plus those of unindexed tracks"""
+        if self._table is None:
+            self.reindex()
+        return [self._table, *self._unindexed.values()]
+
+    @staticmethod
+    def _table_hits(table: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                    query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (track, offset) pairs of every exact sub-fingerprint hit in a lookup table"""
+        hashes, owners, frames = table
+        lo = np.searchsorted(hashes, query, side='left')
+        hi = np.searchsorted(hashes, query, side='right')
+        counts = hi - lo
+        hit_query_frames = np.repeat(np.arange(query.size), counts)
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        hit_rows = starts + np.arange(hit_query_frames.size)
+        return owners[hit_rows].astype(np.int64), frames[hit_rows].astype(np.int64) - hit_query_frames
+
+    def _aligned_ber(self, query: np.ndarray, track: int, offset: int) -> Tuple[float, int]:
+        """BER between the query and a track, with query frame i aligned to track frame i + offset"""
+        length = int(self._lengths[track])
+        start = max(0, -offset)
+        end = min(query.size, length - offset)
+        if end - start <= 0:
+            return 1.0, 0
+        stored = self._matrix[track, start + offset:end + offset]
+        return bit_error_rate(query[start:end], stored), end - start
+
+    def find_matches(self, fingerprint: np.ndarray, threshold: float = MATCH_THRESHOLD,
+                     exclude: Optional[str] = None) -> List[Dict]:
+        """Return indexed tracks whose audio is near-identical to ``fingerprint``, best first"""
+        query = fingerprint[:MAX_FRAMES]
+        if query.size < MIN_OVERLAP_FRAMES:
+            return []
+
+        with self._lock:
+            if not self._keys:
+                return []
+
+            # Vote for (track, offset) alignments using exact sub-fingerprint hits
+            hits = [self._table_hits(table, query) for table in self._lookup_tables()]
+            hit_owners = np.concatenate([owners for owners, _ in hits])
+            hit_offsets = np.concatenate([offsets for _, offsets in hits])
+            candidates = set()
+            if hit_owners.size:
+                if exclude in self._positions:
+                    keep = hit_owners != self._positions[exclude]
+                    hit_owners, hit_offsets = hit_owners[keep], hit_offsets[keep]
+                votes = hit_owners * (2 * MAX_FRAMES) + (hit_offsets + MAX_FRAMES)
+                alignments, vote_counts = np.unique(votes, return_counts=True)
+                for alignment in alignments[np.argsort(vote_counts)[::-1][:MAX_CANDIDATES]]:
+                    candidates.add((int(alignment // (2 * MAX_FRAMES)),
+                                    int(alignment % (2 * MAX_FRAMES)) - MAX_FRAMES))
+
+            best: Dict[int, Tuple[float, int]] = {}
+            for track, offset in candidates:
+                ber, overlap_frames = self._aligned_ber(query, track, offset)
+                if overlap_frames < MIN_OVERLAP_FRAMES or ber >= threshold:
+                    continue
+                if track not in best or ber < best[track][0]:
+                    best[track] = (ber, offset)
+
+            matches = []
+            for track, (ber, offset) in best.items():
+                key = self._keys[track]
+                if key == exclude:
+                    continue
+                matches.append({
+                    'path': key,
+                    'similarity': round(1.0 - ber, 4),
+                    'offset_seconds': round(offset * HOP_SIZE / SAMPLE_RATE, 2),
+                })
+
+        return sorted(matches, key=lambda m: m['similarity'], reverse=True)
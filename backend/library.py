@@ -0,0 +1,466 @@
+"""Persistent index of the audio library.
+
+The index is a small SQLite database inside the downloads folder with one row
+per audio file (path relative to the downloads folder, tags, size, mtime). It
+is synced incrementally from disk, so only files whose mtime changed have their
+tags re-read, and batch operations update it in a single transaction.
+
+An FTS5 table kept in sync by triggers provides full-text search over artist,
+title, genre, folder and file name. Search terms match as prefixes, and terms
+that match nothing are expanded to vocabulary words within a small edit
+distance, which makes queries tolerant to typos.
+"""
+import base64
+import json
+import logging
+import re
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import mutagen
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.m4a', '.flac']
+TAG_FIELDS = ['artist', 'title', 'album', 'genre']
+
+# Sort options for search and listing: name -> (SQL expression, default descending)
+SORT_KEYS = {
+    'relevance': ('m.rank', False),
+    'modified': ('t.mtime', True),
+    'artist': ('lower(t.artist)', False),
+    'title': ('lower(t.title)', False),
+    'name': ('lower(t.name)', False),
+    'size': ('t.size', True),
+}
+MAX_PAGE_SIZE = 500
+MAX_TYPO_EXPANSIONS = 5
+
+
+def clean_filename(filename: str) -> str:
+    """Remove characters that are not safe in file names"""
+    return "".join(c for c in filename if c.isalnum() or c in (' ', '-', '_', '.')).rstrip()
+
+
+def genre_relative_path(genre: str) -> Path:
+    """Map a display genre like "Hip Hop/G-Unit" to its folder path relative to the library root"""
+    # Support nested folders using "/" or "\" as separators
+    folder_path = Path()
+    for part in genre.replace("\\", "/").split("/"):
+        clean_part = part.strip().replace(" ", "_").lower()
+        if clean_part:  # Skip empty parts
+            folder_path = folder_path / clean_part
+    return folder_path
+
+
+def folder_display_name(folder: str) -> str:
+    """Convert a folder path like hip_hop/g-unit back to its display form (Hip Hop/G-Unit)"""
+    return "/".join(part.replace("_", " ").title() for part in folder.split("/") if part)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance between two strings, giving up once it exceeds ``limit``"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # (sort value, path) as written by encode_cursor; anything else would reach SQLite
+    if (not isinstance(values, list) or len(values) != 2
+            or not isinstance(values[0], (str, int, float, type(None)))
+            or not isinstance(values[1], str)):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def read_tags(path: Path) -> Dict[str, str]:
+    """Read artist/title/album/genre tags from any audio format mutagen understands"""
+    tags = {field: '' for field in TAG_FIELDS}
+    try:
+        audio = mutagen.File(str(path), easy=True)
+    except Exception as e:
+        logger.warning(f"Could not read tags from {path}: {e}")
+        return tags
+    if audio is None or audio.tags is None:
+        return tags
+    for field in TAG_FIELDS:
+        values = audio.tags.get(field)
+        if values:
+            tags[field] = str(values[0])
+    return tags
+
+
+class LibraryIndex:
+    """SQLite-backed index of library files and their tags"""
+
+    def __init__(self, db_path: Path, root: Path):
+        self.db_path = db_path
+        self.root = root
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            has_fts = bool(self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tracks_fts'"
+            ).fetchone())
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tracks (
+                    path TEXT PRIMARY KEY,
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    artist TEXT NOT NULL DEFAULT '',
+                    title TEXT NOT NULL DEFAULT '',
+                    album TEXT NOT NULL DEFAULT '',
+                    genre TEXT NOT NULL DEFAULT '',
+                    size INTEGER NOT NULL DEFAULT 0,
+                    mtime REAL NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS tracks_folder ON tracks(folder);
+                CREATE INDEX IF NOT EXISTS tracks_mtime ON tracks(mtime, path);
+                CREATE INDEX IF NOT EXISTS tracks_artist ON tracks(lower(artist), path);
+                CREATE INDEX IF NOT EXISTS tracks_title ON tracks(lower(title), path);
+                CREATE INDEX IF NOT EXISTS tracks_name ON tracks(lower(name), path);
+                CREATE INDEX IF NOT EXISTS tracks_size ON tracks(size, path);
+
+                CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                    artist, title, genre, folder, name,
+                    content='tracks', content_rowid='rowid',
+                    prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS tracks_vocab USING fts5vocab(tracks_fts, row);
+                CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+                    INSERT INTO tracks_fts(rowid, artist, title, genre, folder, name)
+                    VALUES (new.rowid, new.artist, new.title, new.genre, new.folder, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, artist, title, genre, folder, name)
+                    VALUES ('delete', old.rowid, old.artist, old.title, old.genre, old.folder, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, artist, title, genre, folder, name)
+                    VALUES ('delete', old.rowid, old.artist, old.title, old.genre, old.folder, old.name);
+                    INSERT INTO tracks_fts(rowid, artist, title, genre, folder, name)
+                    VALUES (new.rowid, new.artist, new.title, new.genre, new.folder, new.name);
+                END;
+                CREATE TABLE IF NOT EXISTS checksums (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    crc32 INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS analysis (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    duration REAL,
+                    loudness REAL,
+                    loudness_range REAL,
+                    true_peak REAL,
+                    track_gain REAL,
+                    track_peak REAL
+                );
+            """)
+            if not has_fts:
+                # Index rows that were added before full-text search existed
+                self._conn.execute("INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild')")
+
+    def _row_for(self, key: str, tags: Dict[str, str], size: int, mtime: float) -> Tuple:
+        path = Path(key)
+        folder = path.parent.as_posix()
+        return (
+            path.as_posix(), '' if folder == '.' else folder, path.stem,
+            tags.get('artist', ''), tags.get('title', ''), tags.get('album', ''), tags.get('genre', ''),
+            size, mtime,
+        )
+
+    def _upsert(self, rows: Iterable[Tuple]):
+        self._conn.executemany("""
+            INSERT INTO tracks (path, folder, name, artist, title, album, genre, size, mtime)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                folder = excluded.folder, name = excluded.name,
+                artist = excluded.artist, title = excluded.title,
+                album = excluded.album, genre = excluded.genre,
+                size = excluded.size, mtime = excluded.mtime
+        """, rows)
+
+    def sync(self) -> int:
+        """Bring the index up to date with the files on disk; returns the number of changed rows"""
+        on_disk: Dict[str, Tuple[Path, int, float]] = {}
+        for item in self.root.rglob('*'):
+            if item.suffix.lower() in AUDIO_EXTENSIONS and item.is_file():
+                stat = item.stat()
+                on_disk[item.relative_to(self.root).as_posix()] = (item, stat.st_size, stat.st_mtime)
+
+        with self._lock:
+            indexed = {row['path']: row['mtime'] for row in self._conn.execute("SELECT path, mtime FROM tracks")}
+        removed = [key for key in indexed if key not in on_disk]
+        changed = [
+            self._row_for(key, read_tags(item), size, mtime)
+            for key, (item, size, mtime) in on_disk.items()
+            if indexed.get(key) != mtime
+        ]
+        if removed or changed:
+            with self.transaction():
+                self._conn.executemany("DELETE FROM tracks WHERE path = ?", [(key,) for key in removed])
+                self._conn.executemany("DELETE FROM checksums WHERE path = ?", [(key,) for key in removed])
+                self._conn.executemany("DELETE FROM analysis WHERE path = ?", [(key,) for key in removed])
+                self._upsert(changed)
+        return len(removed) + len(changed)
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one transaction"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def update_file(self, key: str):
+        """Re-read a single file into the index"""
+        path = self.root / key
+        stat = path.stat()
+        with self.transaction():
+            self._upsert([self._row_for(key, read_tags(path), stat.st_size, stat.st_mtime)])
+
+    def apply_changes(self, changes: List[Tuple[str, str, Dict[str, str]]]):
+        """Apply (old_key, new_key, tags) updates in a single transaction"""
+        rows = []
+        for old_key, new_key, tags in changes:
+            stat = (self.root / new_key).stat()
+            rows.append((old_key, self._row_for(new_key, tags, stat.st_size, stat.st_mtime)))
+        with self.transaction():
+            old_mtimes = {
+                old_key: self._conn.execute("SELECT mtime FROM tracks WHERE path = ?", (old_key,)).fetchone()
+                for old_key, _ in rows
+            }
+            self._conn.executemany("DELETE FROM tracks WHERE path = ?", [(old_key,) for old_key, _ in rows])
+            self._upsert([row for _, row in rows])
+            # Retagging and moving leave the audio untouched, so analysis that
+            # was current stays current under the new path and mtime
+            self._conn.executemany(
+                "UPDATE OR REPLACE analysis SET path = ?, mtime = ? WHERE path = ? AND mtime = ?",
+                [(row[0], row[8], old_key, old_mtimes[old_key][0]) for old_key, row in rows if old_mtimes[old_key]]
+            )
+            self._conn.executemany(
+                "UPDATE OR REPLACE analysis SET path = ? WHERE path = ?",
+                [(row[0], old_key) for old_key, row in rows if row[0] != old_key]
+            )
+
+    def query(self, sql: str, params: Iterable = ()) -> List[sqlite3.Row]:
+        """Run a read-only query against the index"""
+        with self._lock:
+            return self._conn.execute(sql, tuple(params)).fetchall()
+
+    def select(self, folder: Optional[str] = None, query: Optional[str] = None,
+               paths: Optional[List[str]] = None) -> List[sqlite3.Row]:
+        """Return rows in a genre folder (including subfolders), matching a text query, or listed explicitly"""
+        clauses, params = [], []
+        if folder is not None:
+            prefix = genre_relative_path(folder).as_posix()
+            clauses.append("(folder = ? OR substr(folder, 1, ?) = ?)")
+            params += [prefix, len(prefix) + 1, prefix + '/']
+        if query:
+            match = self.match_expression(query)
+            if match is None:
+                return []
+            clauses.append("rowid IN (SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ?)")
+            params.append(match)
+        if paths is not None:
+            clauses.append(f"path IN ({', '.join('?' * len(paths))})" if paths else "0")
+            params += paths
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self.query(f"SELECT * FROM tracks {where} ORDER BY path", params)
+
+    def _typo_candidates(self, term: str) -> List[str]:
+        """Vocabulary words close to ``term``; the first letter is assumed to be right"""
+        limit = 1 if len(term) <= 4 else 2
+        rows = self.query(
+            "SELECT term, doc FROM tracks_vocab WHERE term >= ? AND term < ? AND length(term) BETWEEN ? AND ?",
+            (term[0], term[0] + '\uffff', len(term) - limit, len(term) + limit)
+        )
+        scored = []
+        for row in rows:
+            distance = edit_distance(term, row['term'], limit)
+            if distance <= limit:
+                scored.append((distance, -row['doc'], row['term']))
+        return [candidate for _, _, candidate in sorted(scored)[:MAX_TYPO_EXPANSIONS]]
+
+    def match_expression(self, query: str) -> Optional[str]:
+        """Build an FTS5 MATCH expression with prefix matching and typo expansion"""
+        # Match the tokenizer, which folds case and strips diacritics
+        folded = ''.join(
+            c for c in unicodedata.normalize('NFKD', query.lower()) if not unicodedata.combining(c)
+        )
+        terms = [term for term in re.split(r'[\W_]+', folded) if term]
+        if not terms:
+            return None
+        parts = []
+        for term in terms:
+            has_prefix_match = self.query(
+                "SELECT 1 FROM tracks_vocab WHERE term >= ? AND term < ? LIMIT 1",
+                (term, term + '\uffff')
+            )
+            options = [f'"{term}"*']
+            if not has_prefix_match:
+                options += [f'"{candidate}"' for candidate in self._typo_candidates(term)]
+            parts.append(f"({' OR '.join(options)})")
+        return ' AND '.join(parts)
+
+    def search(self, query: Optional[str] = None, folder: Optional[str] = None,
+               sort: Optional[str] = None, order: Optional[str] = None,
+               limit: int = 50, cursor: Optional[str] = None) -> Dict:
+        """Search or list tracks with keyset pagination and per-folder facet counts"""
+        sort = sort or ('relevance' if query else 'modified')
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort: {sort}")
+        if sort == 'relevance' and not query:
+            raise ValueError("Sorting by relevance needs a query")
+        expression, descending = SORT_KEYS[sort]
+        if order is not None:
+            if order not in ('asc', 'desc'):
+                raise ValueError(f"Unknown order: {order}")
+            descending = order == 'desc'
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        empty = {'files': [], 'next_cursor': None, 'total': 0, 'facets': []}
+        source, params = "tracks t", []
+        if query:
+            match = self.match_expression(query)
+            if match is None:
+                return empty
+            source = """tracks t JOIN (
+                SELECT rowid, bm25(tracks_fts, 5.0, 5.0, 1.0, 2.0, 1.0) AS rank
+                FROM tracks_fts WHERE tracks_fts MATCH ?
+            ) m ON t.rowid = m.rowid"""
+            params.append(match)
+
+        # Facets ignore the folder filter so the client can offer every genre
+        facet_rows = self.query(
+            f"SELECT t.folder AS folder, COUNT(*) AS count FROM {source} GROUP BY t.folder ORDER BY t.folder",
+            params
+        )
+        prefix = genre_relative_path(folder).as_posix() if folder else None
+        facets = [
+            {'folder': row['folder'], 'genre': folder_display_name(row['folder']), 'count': row['count']}
+            for row in facet_rows
+        ]
+        total = sum(
+            facet['count'] for facet in facets
+            if prefix is None or facet['folder'] == prefix or facet['folder'].startswith(prefix + '/')
+        )
+
+        clauses, page_params = [], list(params)
+        if prefix is not None:
+            clauses.append("(t.folder = ? OR substr(t.folder, 1, ?) = ?)")
+            page_params += [prefix, len(prefix) + 1, prefix + '/']
+        if cursor:
+            clauses.append(f"({expression}, t.path) {'<' if descending else '>'} (?, ?)")
+            page_params += decode_cursor(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        direction = 'DESC' if descending else 'ASC'
+        rows = self.query(
+            f"""SELECT t.*, {expression} AS sort_key,
+                       a.duration AS duration, a.loudness AS loudness, a.true_peak AS true_peak,
+                       a.track_gain AS track_gain, a.track_peak AS track_peak
+                FROM {source} LEFT JOIN analysis a ON a.path = t.path {where}
+                ORDER BY {expression} {direction}, t.path {direction} LIMIT ?""",
+            page_params + [limit + 1]
+        )
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor([rows[-1]['sort_key'], rows[-1]['path']])
+
+        files = [{
+            'name': row['name'],
+            'path': row['path'],
+            'full_path': str(self.root / row['path']),
+            'size': row['size'],
+            'modified': row['mtime'],
+            'artist': row['artist'],
+            'title': row['title'],
+            'genre': row['genre'] or folder_display_name(row['folder']),
+            'folder': row['folder'],
+            'duration': row['duration'],
+            'loudness': row['loudness'],
+            'true_peak': row['true_peak'],
+            'track_gain': row['track_gain'],
+            'track_peak': row['track_peak'],
+        } for row in rows]
+        return {'files': files, 'next_cursor': next_cursor, 'total': total, 'facets': facets}
+
+    def get_crc(self, key: str, size: int, mtime: float) -> Optional[int]:
+        """Return the cached CRC-32 of a file if it has not changed since it was computed"""
+        rows = self.query("SELECT crc32 FROM checksums WHERE path = ? AND size = ? AND mtime = ?", (key, size, mtime))
+        return rows[0]['crc32'] if rows else None
+
+    def set_crc(self, key: str, size: int, mtime: float, crc: int):
+        """Cache the CRC-32 of a file"""
+        with self.transaction():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checksums (path, size, mtime, crc32) VALUES (?, ?, ?, ?)",
+                (key, size, mtime, crc)
+            )
+
+    def get_analysis(self, key: str, mtime: Optional[float] = None) -> Optional[sqlite3.Row]:
+        """Return cached analysis for a file, only if it matches ``mtime`` when given"""
+        rows = self.query("SELECT * FROM analysis WHERE path = ?", (key,))
+        if not rows or (mtime is not None and rows[0]['mtime'] != mtime):
+            return None
+        return rows[0]
+
+    def set_analysis(self, key: str, mtime: float, result: Dict[str, Optional[float]]):
+        """Cache analysis results for a file at the given mtime"""
+        with self.transaction():
+            self._conn.execute("""
+                INSERT OR REPLACE INTO analysis
+                    (path, mtime, duration, loudness, loudness_range, true_peak, track_gain, track_peak)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, mtime, result['duration'], result['loudness'], result['loudness_range'],
+                  result['true_peak'], result['track_gain'], result['track_peak']))
+
+    def unanalyzed_paths(self) -> List[str]:
+        """Paths whose analysis is missing or older than the file"""
+        rows = self.query("""
+            SELECT t.path FROM tracks t LEFT JOIN analysis a ON a.path = t.path
+            WHERE a.path IS NULL OR a.mtime != t.mtime
+            ORDER BY t.mtime DESC
+        """)
+        return [row['path'] for row in rows]
+
+    def get(self, key: str) -> Optional[sqlite3.Row]:
+        """Return the indexed row for ``key``, if any"""
+        rows = self.query("SELECT * FROM tracks WHERE path = ?", (key,))
+        return rows[0] if rows else None
+
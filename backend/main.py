@@ -1,6 +1,6 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from pydantic import BaseModel, HttpUrl
 from typing import List, Optional, Dict, Any, Set
 import asyncio
@@ -16,6 +16,16 @@ import logging
 from datetime import datetime
 import tempfile
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import re
+import itertools
+from fingerprint import FingerprintIndex, fingerprint_file, decode_audio, compute_fingerprint
+from library import LibraryIndex, clean_filename, genre_relative_path
+from ratelimit import RateLimiter, is_throttling_error, MAX_THROTTLE_RETRIES
+from analysis import analyze_file, write_replaygain, lower_priority
+from zipstream import ZipMember, StreamingZip, build_m3u, parse_range
+from retag import (RetagSelector, RetagTransform, RetagItem, id3_padding, path_lock, plan_retag,
+                   apply_item, remove_empty_folders)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -44,16 +54,31 @@ class AudioCutRequest(BaseModel):
     end_time: float
     output_name: Optional[str] = None
 
+class RetagRequest(BaseModel):
+    selector: RetagSelector
+    transform: RetagTransform
+    dry_run: bool = True
+
+class ExportRequest(BaseModel):
+    folder: Optional[str] = None  # Genre folder, including subfolders
+    q: Optional[str] = None  # Text search over artist, title, file name and folder
+    paths: Optional[List[str]] = None  # Explicit paths relative to the downloads folder
+    playlist: bool = False  # Add an .m3u playlist to the archive
+
 class DownloadStatus(BaseModel):
     id: str
     url: str
-    status: str  # pending, downloading, completed, error
+    status: str  # pending, downloading, throttled, completed, error
     progress: float = 0.0
     title: Optional[str] = None
     artist: Optional[str] = None
     clean_title: Optional[str] = None
     error: Optional[str] = None
     file_path: Optional[str] = None
+    audio_duplicates: List[Dict[str, Any]] = []
+    host: Optional[str] = None
+    attempts: int = 0
+    retry_at: Optional[float] = None  # Unix time of the next attempt while throttled
 
 class ConnectionManager:
     def __init__(self):
@@ -75,6 +100,9 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Per-host admission control for downloads and metadata lookups
+rate_limiter = RateLimiter()
+
 # Global storage for download status
 download_queue: Dict[str, DownloadStatus] = {}
 download_history: List[DownloadStatus] = []
@@ -111,25 +139,57 @@ def save_downloaded_url(url: str):
 # Load existing URLs on startup
 load_downloaded_urls()
 
+# Audio fingerprint index used to detect re-uploads of already downloaded tracks
+FINGERPRINT_INDEX_FILE = DOWNLOADS_DIR / "fingerprints.npz"
+fingerprint_index = FingerprintIndex.load(FINGERPRINT_INDEX_FILE)
+# Changes from single downloads are written out at most this often
+FINGERPRINT_SAVE_DELAY = 30.0
+fingerprint_save_task: Optional[asyncio.Task] = None
+
+# SQLite index of library files and tags
+LIBRARY_INDEX_FILE = DOWNLOADS_DIR / "library.db"
+library_index = LibraryIndex(LIBRARY_INDEX_FILE, DOWNLOADS_DIR)
+
+# Batch retag jobs by id
+retag_jobs: Dict[str, Dict[str, Any]] = {}
+
+# Background loudness/duration analysis: new downloads are analyzed before backfill
+ANALYSIS_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+ANALYSIS_PRIORITY_NEW = 0
+ANALYSIS_PRIORITY_BACKFILL = 1
+analysis_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+analysis_order = itertools.count()
+analysis_pool: Optional[ProcessPoolExecutor] = None
+analysis_state: Dict[str, Any] = {
+    'queued': set(),
+    'active': 0,
+    'processed': 0,
+    'failed': 0
+}
+
+# State of the library fingerprinting batch job
+fingerprint_batch: Dict[str, Any] = {
+    'running': False,
+    'total': 0,
+    'processed': 0,
+    'failed': 0,
+    'duplicates': []
+}
+
 def get_genre_folder(genre: str) -> Path:
     """Create and return genre-specific folder with support for nested folders"""
-    # Support nested folders using "/" or "\" as separators
     # Example: "Hip Hop/50 Cent" or "Hip Hop\G-Unit"
-    genre_parts = genre.replace("\\", "/").split("/")
-
-    # Clean each part and create nested folder structure
-    folder_path = DOWNLOADS_DIR
-    for part in genre_parts:
-        clean_part = part.strip().replace(" ", "_").lower()
-        if clean_part:  # Skip empty parts
-            folder_path = folder_path / clean_part
-
+    folder_path = DOWNLOADS_DIR / genre_relative_path(genre)
     folder_path.mkdir(parents=True, exist_ok=True)
     return folder_path
 
 class DownloadProgressHook:
-    def __init__(self, download_id: str):
+    # yt-dlp runs in a worker thread, so broadcasts are handed back to the event loop
+    def __init__(self, download_id: str, loop: asyncio.AbstractEventLoop):
         self.download_id = download_id
+        self.loop = loop
+        self.downloaded_bytes = 0
+        self.elapsed = 0.0
 
     def __call__(self, d):
         if d['status'] == 'downloading':
@@ -143,28 +203,35 @@ class DownloadProgressHook:
             download_queue[self.download_id].progress = progress
             
             # Broadcast progress update
-            asyncio.create_task(manager.broadcast({
+            asyncio.run_coroutine_threadsafe(manager.broadcast({
                 'type': 'progress',
                 'download_id': self.download_id,
                 'progress': progress
-            }))
+            }), self.loop)
         
         elif d['status'] == 'finished':
+            # Used by the rate limiter to spot throughput collapse
+            self.downloaded_bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            self.elapsed += d.get('elapsed') or 0.0
+
             download_queue[self.download_id].status = 'completed'
             download_queue[self.download_id].progress = 100.0
             download_queue[self.download_id].file_path = d['filename']
             
             # Broadcast completion
-            asyncio.create_task(manager.broadcast({
+            asyncio.run_coroutine_threadsafe(manager.broadcast({
                 'type': 'completed',
                 'download_id': self.download_id,
                 'file_path': d['filename']
-            }))
+            }), self.loop)
 
 async def download_video(download_id: str, url: str, genre: str, quality: str = "0"):
-    """Download a single video"""
+    """Download a single video once the host's rate limiter admits it"""
+    limiter = rate_limiter.for_url(url)
+    download_queue[download_id].host = limiter.host
     try:
         genre_folder = get_genre_folder(genre)
+        progress_hook = DownloadProgressHook(download_id, asyncio.get_running_loop())
 
         # yt-dlp options with better file naming and single video download
         ydl_opts = {
@@ -172,7 +239,7 @@ async def download_video(download_id: str, url: str, genre: str, quality: str =
             'outtmpl': str(genre_folder / '%(uploader)s - %(title)s.%(ext)s'),
             'writeinfojson': False,  # Disable info json to avoid clutter
             'noplaylist': True,  # Only download single video, not entire playlist
-            'progress_hooks': [DownloadProgressHook(download_id)],
+            'progress_hooks': [progress_hook],
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'mp3',
@@ -183,82 +250,109 @@ async def download_video(download_id: str, url: str, genre: str, quality: str =
             'audioquality': quality,
         }
         
-        download_queue[download_id].status = 'downloading'
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Extract info first
-            info = ydl.extract_info(url, download=False)
-            video_title = info.get('title', 'Unknown')
-            uploader = info.get('uploader', 'Unknown')
-
-            # Extract artist and clean title
-            artist, clean_title = extract_artist_and_title(video_title, uploader)
+        await limiter.acquire()
+        try:
+            download_queue[download_id].status = 'downloading'
+            download_queue[download_id].retry_at = None
+            download_queue[download_id].attempts += 1
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                # Extract info first
+                info = await asyncio.to_thread(ydl.extract_info, url, download=False)
+                video_title = info.get('title', 'Unknown')
+                uploader = info.get('uploader', 'Unknown')
+
+                # Extract artist and clean title
+                artist, clean_title = extract_artist_and_title(video_title, uploader)
+
+                # Update download status
+                download_queue[download_id].title = video_title
+                download_queue[download_id].artist = artist
+                download_queue[download_id].clean_title = clean_title
+
+                # Broadcast title and artist update
+                await manager.broadcast({
+                    'type': 'metadata_update',
+                    'download_id': download_id,
+                    'title': video_title,
+                    'artist': artist,
+                    'clean_title': clean_title
+                })
 
-            # Update download status
-            download_queue[download_id].title = video_title
-            download_queue[download_id].artist = artist
-            download_queue[download_id].clean_title = clean_title
+                # Download the video
+                await asyncio.to_thread(ydl.download, [url])
+        finally:
+            await limiter.release()
+        await limiter.record_success(progress_hook.downloaded_bytes, progress_hook.elapsed)
+
+        # Find the downloaded MP3 file and add metadata
+        uploader = info.get('uploader', 'Unknown')
+        title = info.get('title', 'Unknown')
+
+        # Try different possible file names
+        possible_names = [
+            f"{uploader} - {title}.mp3",
+            f"{title}.mp3",
+            f"{uploader}_{title}.mp3"
+        ]
 
-            # Broadcast title and artist update
-            await manager.broadcast({
-                'type': 'metadata_update',
-                'download_id': download_id,
-                'title': video_title,
-                'artist': artist,
-                'clean_title': clean_title
-            })
-            
-            # Download the video
-            ydl.download([url])
-
-            # Find the downloaded MP3 file and add metadata
-            uploader = info.get('uploader', 'Unknown')
-            title = info.get('title', 'Unknown')
-
-            # Try different possible file names
-            possible_names = [
-                f"{uploader} - {title}.mp3",
-                f"{title}.mp3",
-                f"{uploader}_{title}.mp3"
-            ]
-
-            mp3_path = None
-            for name in possible_names:
-                potential_path = genre_folder / name
-                if potential_path.exists():
-                    mp3_path = potential_path
-                    break
-
-            # If we still can't find it, look for any .mp3 file in the directory
-            if not mp3_path:
-                mp3_files = list(genre_folder.glob("*.mp3"))
-                if mp3_files:
-                    # Get the most recently created MP3 file
-                    mp3_path = max(mp3_files, key=lambda p: p.stat().st_mtime)
-
-            if mp3_path and mp3_path.exists():
-                add_metadata_to_mp3(str(mp3_path), info, genre)
-
-                # Rename file to a cleaner format: Artist - Title.mp3
-                artist, clean_title = extract_artist_and_title(title, uploader)
-                clean_filename = f"{artist} - {clean_title}.mp3"
-                # Remove invalid characters for filename
-                clean_filename = "".join(c for c in clean_filename if c.isalnum() or c in (' ', '-', '_', '.')).rstrip()
-                new_path = genre_folder / clean_filename
-
-                if mp3_path != new_path:
-                    try:
-                        mp3_path.rename(new_path)
-                        logger.info(f"Renamed file to: {clean_filename}")
-                        # Update the file path in the download queue to the new MP3 path
-                        download_queue[download_id].file_path = str(new_path)
-                    except Exception as e:
-                        logger.warning(f"Could not rename file: {e}")
-                else:
-                    # File wasn't renamed, but update to MP3 path
-                    download_queue[download_id].file_path = str(mp3_path)
+        mp3_path = None
+        for name in possible_names:
+            potential_path = genre_folder / name
+            if potential_path.exists():
+                mp3_path = potential_path
+                break
+
+        # If we still can't find it, look for any .mp3 file in the directory
+        if not mp3_path:
+            mp3_files = list(genre_folder.glob("*.mp3"))
+            if mp3_files:
+                # Get the most recently created MP3 file
+                mp3_path = max(mp3_files, key=lambda p: p.stat().st_mtime)
+
+        if mp3_path and mp3_path.exists():
+            add_metadata_to_mp3(str(mp3_path), info, genre)
+
+            # Rename file to a cleaner format: Artist - Title.mp3
+            artist, clean_title = extract_artist_and_title(title, uploader)
+            # Remove invalid characters for filename
+            clean_name = clean_filename(f"{artist} - {clean_title}.mp3")
+            new_path = genre_folder / clean_name
+
+            if mp3_path != new_path:
+                try:
+                    mp3_path.rename(new_path)
+                    logger.info(f"Renamed file to: {clean_name}")
+                    # Update the file path in the download queue to the new MP3 path
+                    download_queue[download_id].file_path = str(new_path)
+                except Exception as e:
+                    logger.warning(f"Could not rename file: {e}")
             else:
-                logger.warning(f"Could not find downloaded MP3 file for {title}")
+                # File wasn't renamed, but update to MP3 path
+                download_queue[download_id].file_path = str(mp3_path)
+        else:
+            logger.warning(f"Could not find downloaded MP3 file for {title}")
+
+        # Flag near-identical audio that is already in the library
+        final_path = download_queue[download_id].file_path
+        if final_path and Path(final_path).exists():
+            try:
+                await asyncio.to_thread(library_index.update_file, library_key(Path(final_path)))
+                enqueue_analysis(library_key(Path(final_path)), ANALYSIS_PRIORITY_NEW)
+            except Exception as e:
+                logger.warning(f"Could not index {final_path}: {e}")
+            try:
+                matches = await asyncio.to_thread(fingerprint_library_file, Path(final_path))
+                schedule_fingerprint_save()
+                if matches:
+                    download_queue[download_id].audio_duplicates = matches
+                    await manager.broadcast({
+                        'type': 'audio_duplicate',
+                        'download_id': download_id,
+                        'file_path': final_path,
+                        'matches': matches
+                    })
+            except Exception as e:
+                logger.warning(f"Could not fingerprint {final_path}: {e}")
 
         # Move to history
         completed_download = download_queue[download_id]
@@ -272,6 +366,24 @@ async def download_video(download_id: str, url: str, genre: str, quality: str =
         del download_queue[download_id]
         
     except Exception as e:
+        # Throttled jobs go back into the queue after the host's backoff
+        if is_throttling_error(e) and download_queue[download_id].attempts <= MAX_THROTTLE_RETRIES:
+            delay = await limiter.record_throttle()
+            logger.warning(f"Throttled by {limiter.host} for {url}, retrying in {delay:.0f}s")
+            download_queue[download_id].status = 'throttled'
+            download_queue[download_id].error = str(e)
+            download_queue[download_id].progress = 0.0
+            download_queue[download_id].retry_at = datetime.now().timestamp() + delay
+            await manager.broadcast({
+                'type': 'throttled',
+                'download_id': download_id,
+                'host': limiter.host,
+                'retry_at': download_queue[download_id].retry_at,
+                'error': str(e)
+            })
+            asyncio.create_task(retry_download(download_id, url, genre, quality, delay))
+            return
+
         logger.error(f"Download error for {url}: {str(e)}")
         download_queue[download_id].status = 'error'
         download_queue[download_id].error = str(e)
@@ -283,13 +395,25 @@ async def download_video(download_id: str, url: str, genre: str, quality: str =
         })
 
         # Move failed downloads to history after a delay
-        import asyncio
         await asyncio.sleep(5)  # Keep error visible for 5 seconds
         if download_id in download_queue:
             failed_download = download_queue[download_id]
             download_history.append(failed_download)
             del download_queue[download_id]
 
+async def retry_download(download_id: str, url: str, genre: str, quality: str, delay: float):
+    """Requeue a throttled download after a delay"""
+    await asyncio.sleep(delay)
+    if download_id not in download_queue:
+        return
+    download_queue[download_id].status = 'pending'
+    download_queue[download_id].error = None
+    await manager.broadcast({
+        'type': 'requeued',
+        'download_id': download_id
+    })
+    await download_video(download_id, url, genre, quality)
+
 def normalize_string(s: str) -> str:
     """Normalize string for comparison by removing special chars and converting to lowercase"""
     import re
@@ -347,6 +471,263 @@ def find_similar_songs(title: str, artist: str) -> List[Dict]:
 
     return similar_songs
 
+def library_key(path: Path) -> str:
+    """Return the DOWNLOADS_DIR-relative key used by the library indexes"""
+    return str(Path(path).resolve().relative_to(DOWNLOADS_DIR.resolve()))
+
+def describe_audio_matches(matches: List[Dict]) -> List[Dict]:
+    """Attach absolute file paths to fingerprint matches"""
+    return [
+        {**match, 'file_path': str(DOWNLOADS_DIR / match['path'])}
+        for match in matches
+    ]
+
+def index_fingerprint(key: str, fingerprint, mtime: float) -> List[Dict]:
+    """Look up near-identical tracks for a fingerprint, then add it to the index"""
+    matches = fingerprint_index.find_matches(fingerprint, exclude=key)
+    fingerprint_index.add(key, fingerprint, mtime)
+    return matches
+
+def fingerprint_library_file(path: Path) -> List[Dict]:
+    """Fingerprint a library file, add it to the index and return near-identical tracks"""
+    fingerprint = fingerprint_file(str(path))
+    return describe_audio_matches(index_fingerprint(library_key(path), fingerprint, path.stat().st_mtime))
+
+async def save_fingerprint_index_later():
+    await asyncio.sleep(FINGERPRINT_SAVE_DELAY)
+    try:
+        await asyncio.to_thread(fingerprint_index.save)
+    except Exception as e:
+        logger.error(f"Error saving fingerprint index: {e}")
+
+def schedule_fingerprint_save():
+    """Save the fingerprint index soon, batching the changes made in the meantime"""
+    global fingerprint_save_task
+    if fingerprint_save_task is None or fingerprint_save_task.done():
+        fingerprint_save_task = asyncio.create_task(save_fingerprint_index_later())
+
+def find_audio_duplicates_for_info(info: dict) -> List[Dict]:
+    """Fingerprint the remote audio stream described by yt-dlp info and look it up"""
+    stream_url = info.get('url')
+    if not stream_url:
+        return []
+    samples = decode_audio(stream_url, headers=info.get('http_headers'))
+    return describe_audio_matches(fingerprint_index.find_matches(compute_fingerprint(samples)))
+
+def pending_fingerprint_files() -> List[Dict]:
+    """Drop index entries of deleted files and return files missing or stale in the index"""
+    files = scan_audio_files(DOWNLOADS_DIR)
+    existing = {file_info['path'] for file_info in files}
+    for key in [key for key in fingerprint_index.keys() if key not in existing]:
+        fingerprint_index.remove(key)
+    return [
+        file_info for file_info in files
+        if not fingerprint_index.is_current(file_info['path'], file_info['modified'])
+    ]
+
+def find_batch_duplicates(added: List[Dict]) -> List[Dict]:
+    """Build the lookup table once and match every newly fingerprinted file against it
+
+    A pair of duplicates within the batch is reported once, by the later file.
+    """
+    fingerprint_index.reindex()
+    order = {file_info['path']: i for i, file_info in enumerate(added)}
+    duplicates = []
+    for i, file_info in enumerate(added):
+        key = file_info['path']
+        fingerprint = fingerprint_index.get(key)
+        if fingerprint is None:
+            continue
+        matches = [
+            match for match in fingerprint_index.find_matches(fingerprint, exclude=key)
+            if order.get(match['path'], -1) < i
+        ]
+        if matches:
+            duplicates.append({
+                'path': key,
+                'file_path': file_info['full_path'],
+                'matches': describe_audio_matches(matches)
+            })
+    return duplicates
+
+async def fingerprint_library():
+    """Fingerprint every library file that is missing or stale in the index, using all cores"""
+    loop = asyncio.get_running_loop()
+    try:
+        pending = await asyncio.to_thread(pending_fingerprint_files)
+        fingerprint_batch.update({
+            'running': True,
+            'total': len(pending),
+            'processed': 0,
+            'failed': 0,
+            'duplicates': []
+        })
+        await manager.broadcast({'type': 'fingerprint_started', 'total': len(pending)})
+
+        # New fingerprints are only stored while decoding; matching them all
+        # after a single table build avoids rebuilding it as the batch grows
+        added = []
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            async def fingerprint_job(file_info: Dict):
+                try:
+                    fingerprint = await loop.run_in_executor(pool, fingerprint_file, file_info['full_path'])
+                    return file_info, fingerprint, None
+                except Exception as e:
+                    return file_info, None, e
+
+            for job in asyncio.as_completed([fingerprint_job(file_info) for file_info in pending]):
+                file_info, fingerprint, error = await job
+                if error is not None:
+                    fingerprint_batch['failed'] += 1
+                    logger.warning(f"Could not fingerprint {file_info['path']}: {error}")
+                else:
+                    await asyncio.to_thread(
+                        fingerprint_index.add, file_info['path'], fingerprint, file_info['modified'], True
+                    )
+                    added.append(file_info)
+
+                fingerprint_batch['processed'] += 1
+                if fingerprint_batch['processed'] % 50 == 0:
+                    await asyncio.to_thread(fingerprint_index.save)
+                    await manager.broadcast({
+                        'type': 'fingerprint_progress',
+                        'processed': fingerprint_batch['processed'],
+                        'total': fingerprint_batch['total']
+                    })
+
+        fingerprint_batch['duplicates'] = await asyncio.to_thread(find_batch_duplicates, added)
+    except Exception as e:
+        logger.error(f"Error during fingerprint scan: {e}")
+        return
+    finally:
+        await asyncio.to_thread(fingerprint_index.save)
+        fingerprint_batch['running'] = False
+
+    await manager.broadcast({
+        'type': 'fingerprint_completed',
+        'processed': fingerprint_batch['processed'],
+        'failed': fingerprint_batch['failed'],
+        'duplicates': fingerprint_batch['duplicates']
+    })
+
+def plan_library_retag(selector: RetagSelector, transform: RetagTransform) -> List[RetagItem]:
+    """Sync the library index and plan a retag against it"""
+    library_index.sync()
+    rows = library_index.query("SELECT * FROM tracks")
+    return plan_retag(rows, selector, transform, DOWNLOADS_DIR)
+
+async def run_retag_job(job_id: str, items: List[RetagItem]):
+    """Apply a retag plan across a worker pool and update the indexes in one go"""
+    job = retag_jobs[job_id]
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) * 2)) as pool:
+        jobs = [loop.run_in_executor(pool, apply_item, DOWNLOADS_DIR, item) for item in items]
+        for completed in asyncio.as_completed(jobs):
+            item = await completed
+            job['processed'] += 1
+            if item.status == 'error':
+                job['failed'] += 1
+            await manager.broadcast({
+                'type': 'retag_progress',
+                'job_id': job_id,
+                'path': item.path,
+                'new_path': item.new_path,
+                'status': item.status,
+                'error': item.error,
+                'processed': job['processed'],
+                'total': job['total']
+            })
+
+    done = [item for item in items if item.status == 'completed']
+    try:
+        await asyncio.to_thread(
+            library_index.apply_changes,
+            [(item.path, item.new_path, item.new_tags) for item in done]
+        )
+        for item in done:
+            if item.moved:
+                fingerprint_index.rename(item.path, item.new_path)
+            fingerprint_index.update_mtime(item.new_path, (DOWNLOADS_DIR / item.new_path).stat().st_mtime)
+        await asyncio.to_thread(fingerprint_index.save)
+        remove_empty_folders(DOWNLOADS_DIR, [Path(item.path).parent for item in done if item.moved])
+        # Analysis still pending under an old path is dropped, and its cached
+        # results carry over, so this only re-analyzes files that need it
+        for item in done:
+            if item.moved:
+                enqueue_analysis(item.new_path)
+    except Exception as e:
+        logger.error(f"Error updating library index after retag: {e}")
+        job['error'] = str(e)
+
+    job['status'] = 'completed'
+    await manager.broadcast({
+        'type': 'retag_completed',
+        'job_id': job_id,
+        'processed': job['processed'],
+        'failed': job['failed']
+    })
+
+def enqueue_analysis(key: str, priority: int = ANALYSIS_PRIORITY_BACKFILL):
+    """Queue a library file for loudness/duration analysis unless it is already queued"""
+    if key in analysis_state['queued']:
+        return
+    analysis_state['queued'].add(key)
+    analysis_queue.put_nowait((priority, next(analysis_order), key))
+
+def store_analysis(key: str, result: Dict[str, Optional[float]]) -> bool:
+    """Write ReplayGain tags and cache the results, unless the file has been moved away"""
+    path = DOWNLOADS_DIR / key
+    with path_lock(path):
+        if not path.exists():
+            return False
+        tagged = write_replaygain(path, result)
+
+        # Writing tags changes the mtime; cache against the file as it is now
+        mtime = path.stat().st_mtime
+        library_index.set_analysis(key, mtime, result)
+        if tagged:
+            library_index.update_file(key)
+            fingerprint_index.update_mtime(key, mtime)
+    return True
+
+async def analyze_library_file(key: str):
+    """Analyze one file, write ReplayGain tags and cache the results by (path, mtime)"""
+    path = DOWNLOADS_DIR / key
+    if not path.exists():
+        return
+    if await asyncio.to_thread(library_index.get_analysis, key, path.stat().st_mtime):
+        return
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(analysis_pool, analyze_file, str(path))
+    # A retag job moving the file meanwhile queues it again under its new path
+    if not await asyncio.to_thread(store_analysis, key, result):
+        return
+    schedule_fingerprint_save()
+
+    await manager.broadcast({
+        'type': 'analysis_completed',
+        'path': key,
+        **result
+    })
+
+async def analysis_worker():
+    """Process the analysis queue forever, one file at a time"""
+    while True:
+        _, _, key = await analysis_queue.get()
+        analysis_state['active'] += 1
+        try:
+            await analyze_library_file(key)
+            analysis_state['processed'] += 1
+        except Exception as e:
+            analysis_state['failed'] += 1
+            logger.warning(f"Could not analyze {key}: {e}")
+        finally:
+            analysis_state['active'] -= 1
+            analysis_state['queued'].discard(key)
+            analysis_queue.task_done()
+
 def extract_artist_and_title(video_title: str, uploader: str):
     """Extract artist and title from video title using common patterns"""
     title = video_title.lower()
@@ -413,12 +794,45 @@ def add_metadata_to_mp3(file_path: str, info: dict, genre: str):
             except:
                 pass
 
-        audio.save()
+        # Keep room in the ID3 padding so later retags can be written in place
+        audio.save(padding=id3_padding)
         logger.info(f"Added enhanced metadata to {file_path}: Artist='{artist}', Title='{title}', Genre='{genre}'")
 
     except Exception as e:
         logger.error(f"Failed to add metadata to {file_path}: {str(e)}")
 
+@app.on_event("startup")
+async def sync_library_index():
+    """Pick up files added or changed while the server was not running"""
+    async def run_sync():
+        try:
+            changed = await asyncio.to_thread(library_index.sync)
+            logger.info(f"Library index synced ({changed} changes)")
+        except Exception as e:
+            logger.error(f"Error syncing library index: {e}")
+
+    asyncio.create_task(run_sync())
+
+@app.on_event("startup")
+async def start_analysis_workers():
+    """Start the idle-priority analysis pool and its queue workers"""
+    global analysis_pool
+    analysis_pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, initializer=lower_priority)
+    for _ in range(ANALYSIS_WORKERS):
+        asyncio.create_task(analysis_worker())
+
+@app.on_event("shutdown")
+async def stop_analysis_workers():
+    if analysis_pool is not None:
+        analysis_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def flush_fingerprint_index():
+    """Write out fingerprint changes still waiting for a debounced save"""
+    if fingerprint_save_task is not None and not fingerprint_save_task.done():
+        fingerprint_save_task.cancel()
+        await asyncio.to_thread(fingerprint_index.save)
+
 @app.get("/")
 async def root():
     return {"message": "YT-DLP Download Tool API", "status": "running"}
@@ -430,6 +844,7 @@ async def check_duplicates(request: DownloadRequest):
         duplicates = {
             'url_duplicate': False,
             'similar_songs': [],
+            'audio_duplicates': [],
             'warnings': []
         }
 
@@ -445,7 +860,8 @@ async def check_duplicates(request: DownloadRequest):
 
             # Extract video info to check for similar songs
             try:
-                with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+                await rate_limiter.for_url(url_str).acquire_token()
+                with yt_dlp.YoutubeDL({'quiet': True, 'format': 'bestaudio/best'}) as ydl:
                     info = ydl.extract_info(url_str, download=False)
                     video_title = info.get('title', 'Unknown')
                     uploader = info.get('uploader', 'Unknown')
@@ -464,6 +880,23 @@ async def check_duplicates(request: DownloadRequest):
                         }])
                         duplicates['warnings'].append(f"Similar song found for: {artist} - {clean_title}")
 
+                    # Compare the actual audio against the fingerprint index, which
+                    # catches re-uploads and lyric videos with different titles
+                    if len(fingerprint_index):
+                        try:
+                            audio_matches = await asyncio.to_thread(find_audio_duplicates_for_info, info)
+                        except Exception as e:
+                            logger.warning(f"Could not fingerprint audio for {url_str}: {e}")
+                            audio_matches = []
+                        if audio_matches:
+                            duplicates['audio_duplicates'].append({
+                                'url': url_str,
+                                'new_title': clean_title,
+                                'new_artist': artist,
+                                'matching_files': audio_matches
+                            })
+                            duplicates['warnings'].append(f"Identical audio already downloaded for: {artist} - {clean_title}")
+
             except Exception as e:
                 logger.warning(f"Could not check duplicates for {url_str}: {e}")
 
@@ -497,6 +930,88 @@ async def start_download(request: DownloadRequest):
     
     return {"message": "Downloads started", "download_ids": download_ids}
 
+@app.post("/library/retag")
+async def retag_library(request: RetagRequest):
+    """Plan a batch retag/reorganization, and run it unless dry_run is set"""
+    try:
+        items = await asyncio.to_thread(plan_library_retag, request.selector, request.transform)
+    except (ValueError, re.error) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if request.dry_run:
+        return {"dry_run": True, "count": len(items), "items": items}
+
+    job_id = str(uuid.uuid4())
+    retag_jobs[job_id] = {
+        'id': job_id,
+        'status': 'running',
+        'total': len(items),
+        'processed': 0,
+        'failed': 0,
+        'error': None,
+        'items': items
+    }
+    asyncio.create_task(run_retag_job(job_id, items))
+    return {"dry_run": False, "job_id": job_id, "count": len(items)}
+
+@app.get("/library/retag/{job_id}")
+async def get_retag_job(job_id: str):
+    """Get progress and per-file results of a retag job"""
+    if job_id not in retag_jobs:
+        raise HTTPException(status_code=404, detail="Retag job not found")
+    return retag_jobs[job_id]
+
+@app.post("/analysis/backfill")
+async def backfill_analysis():
+    """Queue every library file without current loudness/duration analysis"""
+    await asyncio.to_thread(library_index.sync)
+    keys = await asyncio.to_thread(library_index.unanalyzed_paths)
+    for key in keys:
+        enqueue_analysis(key, ANALYSIS_PRIORITY_BACKFILL)
+    return {"queued": len(keys)}
+
+@app.get("/analysis/status")
+async def get_analysis_status():
+    """Get the analysis queue length and counters"""
+    return {
+        "queued": len(analysis_state['queued']),
+        "active": analysis_state['active'],
+        "processed": analysis_state['processed'],
+        "failed": analysis_state['failed'],
+        "workers": ANALYSIS_WORKERS
+    }
+
+@app.get("/analysis/{file_path:path}")
+async def get_file_analysis(file_path: str):
+    """Get precomputed loudness, peak and duration for a library file"""
+    row = await asyncio.to_thread(library_index.get_analysis, file_path)
+    if row is None:
+        raise HTTPException(status_code=404, detail="No analysis for this file yet")
+    return dict(row)
+
+@app.post("/fingerprints/scan")
+async def scan_fingerprints():
+    """Fingerprint the existing library in the background"""
+    if fingerprint_batch['running']:
+        raise HTTPException(status_code=409, detail="Fingerprint scan already running")
+
+    fingerprint_batch['running'] = True
+    asyncio.create_task(fingerprint_library())
+    return {"message": "Fingerprint scan started"}
+
+@app.get("/fingerprints/status")
+async def get_fingerprint_status():
+    """Get fingerprint index size and progress of the library scan"""
+    return {
+        "indexed": len(fingerprint_index),
+        **fingerprint_batch
+    }
+
+@app.get("/rate-limits")
+async def get_rate_limits():
+    """Get the current admission limits and backoff state per host"""
+    return {"hosts": rate_limiter.snapshot()}
+
 @app.get("/status")
 async def get_status():
     """Get current download status"""
@@ -633,6 +1148,27 @@ async def get_audio_files():
         logger.error(f"Error scanning audio files: {e}")
         return {"files": []}
 
+@app.get("/search")
+async def search_library(q: Optional[str] = None, folder: Optional[str] = None,
+                         sort: Optional[str] = None, order: Optional[str] = None,
+                         limit: int = 50, cursor: Optional[str] = None):
+    """Full-text search and paginated listing of the library
+
+    Pass ``next_cursor`` from a response as ``cursor`` to get the next page.
+    """
+    try:
+        return await asyncio.to_thread(
+            library_index.search, query=q, folder=folder, sort=sort, order=order, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/library/reindex")
+async def reindex_library():
+    """Re-scan the downloads folder into the library index"""
+    changed = await asyncio.to_thread(library_index.sync)
+    return {"changed": changed}
+
 @app.get("/audio/{file_path:path}")
 async def serve_audio_file(file_path: str):
     """Serve audio file for playback"""
@@ -768,6 +1304,89 @@ async def download_file_to_pc(file_path: str):
         logger.error(f"Error downloading file: {e}")
         raise HTTPException(status_code=500, detail="Error downloading file")
 
+def build_export_archive(selection: ExportRequest):
+    """Build the deterministic ZIP layout for an export selection"""
+    if selection.folder is None and not selection.q and selection.paths is None:
+        raise ValueError("Export needs a folder, a search query or a list of paths")
+
+    library_index.sync()
+    rows = library_index.select(folder=selection.folder, query=selection.q, paths=selection.paths)
+    if not rows:
+        raise LookupError("No files match the export selection")
+
+    members = []
+    for row in rows:
+        path = DOWNLOADS_DIR / row['path']
+        stat = path.stat()
+        members.append(ZipMember(row['path'], path=path, size=stat.st_size, mtime=stat.st_mtime))
+
+    name = genre_relative_path(selection.folder).name if selection.folder else "export"
+    if selection.playlist:
+        entries = [
+            (row['path'], f"{row['artist']} - {row['title']}" if row['artist'] and row['title'] else row['name'])
+            for row in rows
+        ]
+        members.append(ZipMember(
+            f"{name}.m3u",
+            data=build_m3u(entries),
+            mtime=max(member.mtime for member in members)
+        ))
+
+    archive = StreamingZip(
+        members,
+        crc_lookup=lambda member: library_index.get_crc(member.arcname, member.size, member.mtime),
+        crc_store=lambda member, crc: library_index.set_crc(member.arcname, member.size, member.mtime, crc)
+    )
+    return archive, f"{clean_filename(name) or 'export'}.zip"
+
+async def export_response(request: Request, selection: ExportRequest):
+    """Stream an export archive, honouring Range/If-Range for resumed downloads"""
+    try:
+        archive, filename = await asyncio.to_thread(build_export_archive, selection)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    headers = {
+        "Content-Disposition": f"attachment; filename=\"{filename}\"",
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag
+    }
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range == archive.etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), archive.size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{archive.size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(archive.iter_range(), media_type="application/zip", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start)
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{archive.size}"
+    return StreamingResponse(
+        archive.iter_range(start, end),
+        status_code=206,
+        media_type="application/zip",
+        headers=headers
+    )
+
+@app.get("/api/export")
+async def export_zip(request: Request, folder: Optional[str] = None, q: Optional[str] = None,
+                     path: Optional[List[str]] = Query(None), playlist: bool = False):
+    """Download a genre folder, search result or list of files as a ZIP archive"""
+    return await export_response(request, ExportRequest(folder=folder, q=q, paths=path, playlist=playlist))
+
+@app.post("/api/export")
+async def export_zip_selection(request: Request, selection: ExportRequest):
+    """Same as GET /api/export, for selections too long for a query string"""
+    return await export_response(request, selection)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
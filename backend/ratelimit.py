@@ -0,0 +1,235 @@
+"""Per-host admission control for downloads.
+
+Every upstream host (youtube.com, soundcloud.com, ...) gets its own limiter
+combining a token bucket, which caps how often jobs may start, with an
+adaptive concurrency limit. The limit follows AIMD: each success raises it by
+``1 / limit`` and each throttling event halves it. A 429 or a "too many
+requests" style error also halves the token rate and opens a cool-down window
+before any new job starts; further errors during that window belong to the
+same event and only wait for it to end. A download whose throughput collapses
+far below the host's running average counts as a soft throttle, so the limit
+is reduced but the job is not retried. Soft throttles are grouped the same
+way, so downloads that slow down together only reduce the limit once.
+"""
+import asyncio
+import random
+import re
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+# Defaults per host
+INITIAL_CONCURRENCY = 2.0
+MAX_CONCURRENCY = 4.0
+MIN_CONCURRENCY = 1.0
+BASE_RATE_PER_MINUTE = 20.0
+MIN_RATE_PER_MINUTE = 2.0
+BUCKET_CAPACITY = 5.0
+
+# Backoff after a throttling error: doubles per consecutive throttle
+BASE_BACKOFF = 30.0
+MAX_BACKOFF = 15 * 60.0
+
+# Throughput collapse: a download slower than this fraction of the running
+# average (once enough samples exist) counts as a soft throttle
+COLLAPSE_RATIO = 0.25
+COLLAPSE_MIN_SAMPLES = 3
+THROUGHPUT_ALPHA = 0.2
+# Further collapses within this many seconds belong to the same soft throttle
+SOFT_THROTTLE_WINDOW = 60.0
+
+MAX_THROTTLE_RETRIES = 5
+
+# A bare "429" also turns up in video ids and byte counts, so only HTTP
+# style statuses count; exceptions with a status attribute are checked directly
+_THROTTLE_RE = re.compile(
+    r'http error 429\b'
+    r'|\b(?:status|status code|response code|http)[ :=]+429\b'
+    r'|too many requests'
+    r'|rate[- ]?limit'
+    r"|confirm you(?:'|\u2019)re not a bot"
+)
+
+_HOST_ALIASES = {
+    'youtu.be': 'youtube.com',
+    'music.youtube.com': 'youtube.com',
+}
+
+
+def host_for_url(url: str) -> str:
+    """Return the limiter key for a URL, folding mirrors and mobile hosts together"""
+    host = (urlparse(url).hostname or 'unknown').lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return _HOST_ALIASES.get(host, host)
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """Check whether an exception (or what it wraps) means the host is throttling us"""
+    seen = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        if getattr(current, 'status', None) == 429 or getattr(current, 'code', None) == 429:
+            return True
+        message = str(current).lower()
+        if _THROTTLE_RE.search(message):
+            return True
+        # yt-dlp keeps the original exception in exc_info
+        exc_info = getattr(current, 'exc_info', None)
+        wrapped = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        current = wrapped or current.__cause__ or current.__context__
+    return False
+
+
+class HostLimiter:
+    """Token bucket plus AIMD concurrency limit for a single host"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.limit = INITIAL_CONCURRENCY
+        self.rate = BASE_RATE_PER_MINUTE
+        self.tokens = BUCKET_CAPACITY
+        self.active = 0
+        self.waiting = 0
+        self.backoff_until = 0.0
+        self.soft_throttle_until = 0.0
+        self.consecutive_throttles = 0
+        self.throttle_count = 0
+        self.soft_throttle_count = 0
+        self.completed = 0
+        self.throughput: Optional[float] = None  # bytes/s, running average
+        self.throughput_samples = 0
+        self._updated = time.monotonic()
+        self._condition = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(BUCKET_CAPACITY, self.tokens + (now - self._updated) * self.rate / 60.0)
+        self._updated = now
+
+    def _wait_time(self, need_slot: bool) -> float:
+        """Seconds until a job may start, or 0 if it may start now"""
+        now = time.monotonic()
+        if now < self.backoff_until:
+            return self.backoff_until - now
+        if need_slot and self.active >= int(self.limit):
+            return float('inf')
+        self._refill()
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) * 60.0 / self.rate
+        return 0.0
+
+    async def _acquire(self, need_slot: bool):
+        async with self._condition:
+            self.waiting += 1
+            try:
+                while True:
+                    wait = self._wait_time(need_slot)
+                    if wait <= 0:
+                        break
+                    try:
+                        # Releases and state changes notify; otherwise wake when the wait is over
+                        await asyncio.wait_for(self._condition.wait(), None if wait == float('inf') else wait)
+                    except asyncio.TimeoutError:
+                        pass
+                self.tokens -= 1.0
+                if need_slot:
+                    self.active += 1
+            finally:
+                self.waiting -= 1
+
+    async def acquire(self):
+        """Wait for a download slot and a token"""
+        await self._acquire(need_slot=True)
+
+    async def acquire_token(self):
+        """Wait for a token only, for lightweight requests such as metadata lookups"""
+        await self._acquire(need_slot=False)
+
+    async def release(self):
+        async with self._condition:
+            self.active = max(0, self.active - 1)
+            self._condition.notify_all()
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _decrease(self, factor: float):
+        self.limit = max(MIN_CONCURRENCY, self.limit * factor)
+
+    async def record_success(self, num_bytes: Optional[float] = None, elapsed: Optional[float] = None):
+        """Grow the limits after a completed download, unless its throughput collapsed"""
+        self.completed += 1
+        self.consecutive_throttles = 0
+        collapsed = False
+        if num_bytes and elapsed and elapsed > 0:
+            speed = num_bytes / elapsed
+            if self.throughput is not None and self.throughput_samples >= COLLAPSE_MIN_SAMPLES:
+                collapsed = speed < self.throughput * COLLAPSE_RATIO
+            self.throughput = speed if self.throughput is None else (
+                THROUGHPUT_ALPHA * speed + (1 - THROUGHPUT_ALPHA) * self.throughput
+            )
+            self.throughput_samples += 1
+
+        if collapsed:
+            now = time.monotonic()
+            if now >= self.soft_throttle_until:
+                self.soft_throttle_count += 1
+                self._decrease(0.5)
+                self.soft_throttle_until = now + SOFT_THROTTLE_WINDOW
+        else:
+            self.limit = min(MAX_CONCURRENCY, self.limit + 1.0 / self.limit)
+            self.rate = min(BASE_RATE_PER_MINUTE, self.rate * 1.1)
+        await self._notify()
+
+    async def record_throttle(self) -> float:
+        """Back off after a throttling error; returns the delay before the job should retry"""
+        now = time.monotonic()
+        if now < self.backoff_until:
+            # Other in-flight jobs failing on the same event share its backoff
+            return self.backoff_until - now
+        self.throttle_count += 1
+        self.consecutive_throttles += 1
+        self._decrease(0.5)
+        self.rate = max(MIN_RATE_PER_MINUTE, self.rate / 2)
+        delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (self.consecutive_throttles - 1))
+        delay *= random.uniform(0.8, 1.2)
+        self.backoff_until = now + delay
+        await self._notify()
+        return delay
+
+    def snapshot(self) -> Dict:
+        self._refill()
+        return {
+            'host': self.host,
+            'concurrency_limit': int(self.limit),
+            'concurrency_target': round(self.limit, 2),
+            'active': self.active,
+            'waiting': self.waiting,
+            'rate_per_minute': round(self.rate, 2),
+            'tokens': round(self.tokens, 2),
+            'backoff_seconds': round(max(0.0, self.backoff_until - time.monotonic()), 1),
+            'throttled': self.throttle_count,
+            'soft_throttled': self.soft_throttle_count,
+            'completed': self.completed,
+            'throughput_bytes_per_second': round(self.throughput) if self.throughput else None,
+        }
+
+
+class RateLimiter:
+    """Registry of per-host limiters"""
+
+    def __init__(self):
+        self.hosts: Dict[str, HostLimiter] = {}
+
+    def for_url(self, url: str) -> HostLimiter:
+        host = host_for_url(url)
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(host)
+        return self.hosts[host]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {host: limiter.snapshot() for host, limiter in sorted(self.hosts.items())}
@@ -0,0 +1,240 @@
+"""Batch retagging and reorganization of library files.
+
+A retag runs in two phases. ``plan_retag`` resolves a selector against the
+library index and computes the new tags and location of every matching file
+without touching the disk, so the plan can be reviewed as a dry run.
+``apply_item`` then executes one planned item: tags are written into the
+existing ID3 padding where they fit, so the audio data is not rewritten, and
+the file is moved by hard-linking it to its new path and unlinking the old
+one. The link fails if the target exists, so a move never overwrites another
+file; where hard links are not supported it falls back to a rename after
+checking that the target is free.
+"""
+import os
+import re
+import threading
+import weakref
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import mutagen
+from pydantic import BaseModel
+
+from library import TAG_FIELDS, clean_filename, genre_relative_path
+
+# Padding reserved whenever a tag has to be rewritten anyway, so that later
+# edits fit in place
+ID3_PADDING = 16 * 1024
+
+# One lock per file path, shared by everything that rewrites or moves files
+_path_locks = weakref.WeakValueDictionary()
+_path_locks_guard = threading.Lock()
+
+
+def id3_padding(info) -> int:
+    """mutagen padding callback that keeps tags in place whenever they fit"""
+    if info.padding >= 0:
+        return info.padding
+    return ID3_PADDING
+
+
+def path_lock(path: Path) -> threading.RLock:
+    """Return the lock serializing tag writes and moves of a library file"""
+    key = os.path.abspath(path)
+    with _path_locks_guard:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = _path_locks[key] = threading.RLock()
+        return lock
+
+
+class RetagSelector(BaseModel):
+    folder: Optional[str] = None  # Genre folder, e.g. "Hip Hop/G-Unit" (includes subfolders)
+    artist: Optional[str] = None  # Exact artist tag, case-insensitive
+    pattern: Optional[str] = None  # Regex searched in the relative path
+    paths: Optional[List[str]] = None  # Explicit relative paths
+
+
+class FieldReplacement(BaseModel):
+    field: str
+    pattern: str
+    replacement: str = ""
+
+
+class RetagTransform(BaseModel):
+    artist: Optional[str] = None
+    title: Optional[str] = None
+    album: Optional[str] = None
+    genre: Optional[str] = None
+    replace: List[FieldReplacement] = []
+    move_to: Optional[str] = None  # Target genre folder, e.g. "Rap/G-Unit"
+    rename: bool = True  # Rename files to "Artist - Title" when those tags change
+
+
+class RetagItem(BaseModel):
+    path: str
+    new_path: str
+    old_tags: Dict[str, str]
+    new_tags: Dict[str, str]
+    status: str = 'planned'  # planned, completed, error
+    error: Optional[str] = None
+
+    @property
+    def tags_changed(self) -> bool:
+        return self.old_tags != self.new_tags
+
+    @property
+    def moved(self) -> bool:
+        return self.path != self.new_path
+
+
+def _in_folder(folder: str, prefix: str) -> bool:
+    return folder == prefix or folder.startswith(prefix + '/')
+
+
+def select_rows(rows: Iterable, selector: RetagSelector) -> List:
+    """Filter library index rows with a selector; every given criterion must match"""
+    prefix = genre_relative_path(selector.folder).as_posix() if selector.folder else None
+    artist = selector.artist.strip().lower() if selector.artist else None
+    pattern = re.compile(selector.pattern, re.IGNORECASE) if selector.pattern else None
+    paths = set(selector.paths) if selector.paths else None
+
+    if prefix is None and artist is None and pattern is None and paths is None:
+        raise ValueError("Selector must specify at least one of folder, artist, pattern or paths")
+
+    selected = []
+    for row in rows:
+        if prefix is not None and not _in_folder(row['folder'], prefix):
+            continue
+        if artist is not None and row['artist'].strip().lower() != artist:
+            continue
+        if pattern is not None and not pattern.search(row['path']):
+            continue
+        if paths is not None and row['path'] not in paths:
+            continue
+        selected.append(row)
+    return selected
+
+
+def plan_retag(rows: Iterable, selector: RetagSelector, transform: RetagTransform,
+               root: Path) -> List[RetagItem]:
+    """Compute the tag and location changes for every selected file without applying them"""
+    for replacement in transform.replace:
+        if replacement.field not in TAG_FIELDS:
+            raise ValueError(f"Unknown tag field: {replacement.field}")
+    replacements = [(r.field, re.compile(r.pattern), r.replacement) for r in transform.replace]
+    source_prefix = genre_relative_path(selector.folder) if selector.folder else None
+    target_folder = genre_relative_path(transform.move_to) if transform.move_to else None
+
+    items = []
+    for row in select_rows(rows, selector):
+        old_tags = {field: row[field] for field in TAG_FIELDS}
+        new_tags = dict(old_tags)
+        for field in TAG_FIELDS:
+            value = getattr(transform, field)
+            if value is not None:
+                new_tags[field] = value
+        for field, pattern, replacement in replacements:
+            new_tags[field] = pattern.sub(replacement, new_tags[field]).strip()
+
+        # Moving into another genre folder retags the genre like a fresh download would
+        if transform.move_to and transform.genre is None:
+            new_tags['genre'] = transform.move_to
+            if transform.album is None and old_tags['album'] == f"{old_tags['genre']} Collection":
+                new_tags['album'] = f"{transform.move_to} Collection"
+
+        old_path = Path(row['path'])
+        folder = old_path.parent
+        if target_folder is not None:
+            folder = target_folder
+            if source_prefix is not None and _in_folder(old_path.parent.as_posix(), source_prefix.as_posix()):
+                # Keep the layout below the selected folder
+                folder = target_folder / old_path.parent.relative_to(source_prefix)
+
+        name = old_path.name
+        naming_changed = (new_tags['artist'], new_tags['title']) != (old_tags['artist'], old_tags['title'])
+        if transform.rename and naming_changed and new_tags['artist'] and new_tags['title']:
+            name = clean_filename(f"{new_tags['artist']} - {new_tags['title']}") + old_path.suffix.lower()
+
+        item = RetagItem(
+            path=old_path.as_posix(),
+            new_path=(folder / name).as_posix(),
+            old_tags=old_tags,
+            new_tags=new_tags,
+        )
+        if item.tags_changed or item.moved:
+            items.append(item)
+
+    # Refuse moves onto existing files or onto another planned target
+    sources = {item.path for item in items}
+    targets: Dict[str, RetagItem] = {}
+    for item in items:
+        if not item.moved:
+            continue
+        if item.new_path in targets:
+            item.status = 'error'
+            item.error = f"Target also planned for {targets[item.new_path].path}"
+        elif (root / item.new_path).exists() and item.new_path not in sources:
+            item.status = 'error'
+            item.error = "Target file already exists"
+        else:
+            targets[item.new_path] = item
+    return items
+
+
+def write_tags(path: Path, tags: Dict[str, str]):
+    """Write tags in place, only growing the file when the existing padding is too small"""
+    with path_lock(path):
+        audio = mutagen.File(str(path), easy=True)
+        if audio is None:
+            raise ValueError("Unsupported audio format")
+        if audio.tags is None:
+            audio.add_tags()
+        for field in TAG_FIELDS:
+            if tags[field]:
+                audio.tags[field] = tags[field]
+            elif field in audio.tags:
+                del audio.tags[field]
+        audio.save(padding=id3_padding)
+
+
+def move_file(source: Path, target: Path):
+    """Atomically move a file, refusing to overwrite an existing one"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # A hard link fails if the target exists, so nothing can be clobbered
+        os.link(source, target)
+        os.unlink(source)
+    except FileExistsError:
+        raise
+    except OSError:
+        if target.exists():
+            raise FileExistsError(f"Target file already exists: {target}")
+        os.rename(source, target)
+
+
+def apply_item(root: Path, item: RetagItem) -> RetagItem:
+    """Apply a single planned item; errors are recorded on the item instead of raised"""
+    if item.status == 'error':
+        return item
+    try:
+        source = root / item.path
+        with path_lock(source):
+            if item.tags_changed:
+                write_tags(source, item.new_tags)
+            if item.moved:
+                move_file(source, root / item.new_path)
+        item.status = 'completed'
+    except Exception as e:
+        item.status = 'error'
+        item.error = str(e)
+    return item
+
+
+def remove_empty_folders(root: Path, folders: Iterable[Path]):
+    """Remove folders left empty by moves, walking up towards the library root"""
+    for folder in sorted(set(folders), key=lambda p: len(p.parts), reverse=True):
+        current = root / folder
+        while current != root and current.is_dir() and not any(current.iterdir()):
+            current.rmdir()
+            current = current.parent
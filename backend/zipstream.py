@@ -0,0 +1,267 @@
+"""Streaming ZIP archives for library exports.
+
+Archives are written on the fly with every member stored (audio is already
+compressed), so their layout only depends on file names, sizes and mtimes.
+That makes the total length known before the first byte is sent and lets any
+byte range be regenerated, which is what HTTP Range resuming needs.
+
+Members use data descriptors, so the CRC-32 of a file is only needed after
+its data has been sent. CRCs computed while streaming are handed to a cache
+callback; a resumed request that starts past a file reads the cache and only
+re-reads the file when it has never been streamed in full before.
+"""
+import hashlib
+import struct
+import time
+import zlib
+from bisect import bisect_right
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+CHUNK_SIZE = 256 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+class ZipMember:
+    """A file (or in-memory blob) placed in the archive"""
+
+    def __init__(self, arcname: str, path: Optional[Path] = None, data: Optional[bytes] = None,
+                 size: int = 0, mtime: float = 0.0):
+        self.arcname = arcname
+        self.name_bytes = arcname.encode('utf-8')
+        self.path = path
+        self.data = data
+        self.size = len(data) if data is not None else size
+        self.mtime = mtime
+        self.offset = 0
+        self.crc: Optional[int] = zlib.crc32(data) if data is not None else None
+
+    @property
+    def zip64(self) -> bool:
+        return self.size >= ZIP64_LIMIT
+
+    @property
+    def dos_time(self) -> Tuple[int, int]:
+        t = time.localtime(self.mtime)
+        if t.tm_year < 1980:
+            return 0, (0 << 9) | (1 << 5) | 1
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        return dos_time, dos_date
+
+    def local_header(self) -> bytes:
+        dos_time, dos_date = self.dos_time
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+        else:
+            extra = b''
+            sizes = (0, 0)
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if self.zip64 else 20,
+            FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0, dos_time, dos_date,
+            0, sizes[0], sizes[1], len(self.name_bytes), len(extra),
+        ) + self.name_bytes + extra
+
+    def descriptor_size(self) -> int:
+        return 24 if self.zip64 else 16
+
+    def descriptor(self) -> bytes:
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+    def _central_extra(self) -> bytes:
+        fields = []
+        if self.size >= ZIP64_LIMIT:
+            fields += [self.size, self.size]
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+        if not fields:
+            return b''
+        return struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields)
+
+    def central_size(self) -> int:
+        return 46 + len(self.name_bytes) + len(self._central_extra())
+
+    def central_record(self) -> bytes:
+        dos_time, dos_date = self.dos_time
+        extra = self._central_extra()
+        version = 45 if extra else 20
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version,
+            FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0, dos_time, dos_date, self.crc,
+            min(self.size, ZIP64_LIMIT), min(self.size, ZIP64_LIMIT),
+            len(self.name_bytes), len(extra), 0, 0, 0, 0o100644 << 16,
+            min(self.offset, ZIP64_LIMIT),
+        ) + self.name_bytes + extra
+
+
+class StreamingZip:
+    """Deterministic stored ZIP whose bytes can be produced for any range
+
+    ``crc_lookup(member)`` returns a cached CRC-32 or None, and
+    ``crc_store(member, crc)`` is called whenever a CRC was computed.
+    """
+
+    def __init__(self, members: List[ZipMember],
+                 crc_lookup: Optional[Callable[[ZipMember], Optional[int]]] = None,
+                 crc_store: Optional[Callable[[ZipMember, int], None]] = None):
+        self.members = members
+        self.crc_lookup = crc_lookup
+        self.crc_store = crc_store
+        # Segments are (start offset, length, kind, member)
+        self._segments: List[Tuple[int, int, str, Optional[ZipMember]]] = []
+        offset = 0
+
+        def add(kind: str, length: int, member: Optional[ZipMember] = None):
+            nonlocal offset
+            self._segments.append((offset, length, kind, member))
+            offset += length
+
+        for member in members:
+            member.offset = offset
+            add('local', len(member.local_header()), member)
+            add('data', member.size, member)
+            add('descriptor', member.descriptor_size(), member)
+        self._central_offset = offset
+        for member in members:
+            add('central', member.central_size(), member)
+        self._central_size = offset - self._central_offset
+        add('end', len(self._end_record()))
+        self.size = offset
+        self._starts = [segment[0] for segment in self._segments]
+
+    @property
+    def etag(self) -> str:
+        """Identifies the exact layout, for If-Range checks"""
+        digest = hashlib.sha1()
+        for member in self.members:
+            digest.update(member.name_bytes)
+            digest.update(struct.pack('<Qd', member.size, member.mtime))
+        return f'"{digest.hexdigest()}"'
+
+    def _end_record(self) -> bytes:
+        count = len(self.members)
+        needs_zip64 = (
+            count >= ZIP64_COUNT_LIMIT
+            or self._central_offset >= ZIP64_LIMIT
+            or self._central_size >= ZIP64_LIMIT
+        )
+        record = b''
+        if needs_zip64:
+            zip64_end_offset = self._central_offset + self._central_size
+            record += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                count, count, self._central_size, self._central_offset,
+            )
+            record += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+        record += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0,
+            min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+            min(self._central_size, ZIP64_LIMIT), min(self._central_offset, ZIP64_LIMIT), 0,
+        )
+        return record
+
+    def _ensure_crc(self, member: ZipMember) -> int:
+        if member.crc is None and self.crc_lookup is not None:
+            member.crc = self.crc_lookup(member)
+        if member.crc is None:
+            crc = 0
+            with open(member.path, 'rb') as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    crc = zlib.crc32(chunk, crc)
+            self._set_crc(member, crc)
+        return member.crc
+
+    def _set_crc(self, member: ZipMember, crc: int):
+        member.crc = crc
+        if self.crc_store is not None and member.path is not None:
+            self.crc_store(member, crc)
+
+    def _iter_data(self, member: ZipMember, start: int, end: int) -> Iterator[bytes]:
+        """Yield member data in [start, end), computing the CRC when the whole file passes by"""
+        if member.data is not None:
+            yield member.data[start:end]
+            return
+        if member.path.stat().st_size != member.size:
+            raise RuntimeError(f"{member.arcname} changed while exporting")
+        track_crc = start == 0 and end == member.size and member.crc is None
+        crc = 0
+        with open(member.path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise RuntimeError(f"{member.arcname} was truncated while exporting")
+                if track_crc:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if track_crc:
+            self._set_crc(member, crc)
+
+    def _segment_bytes(self, kind: str, member: Optional[ZipMember]) -> bytes:
+        if kind == 'local':
+            return member.local_header()
+        if kind == 'descriptor':
+            self._ensure_crc(member)
+            return member.descriptor()
+        if kind == 'central':
+            self._ensure_crc(member)
+            return member.central_record()
+        return self._end_record()
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yield the archive bytes in [start, end)"""
+        end = self.size if end is None else end
+        index = bisect_right(self._starts, start) - 1
+        while index < len(self._segments) and start < end:
+            seg_start, length, kind, member = self._segments[index]
+            seg_end = seg_start + length
+            lo, hi = start - seg_start, min(end, seg_end) - seg_start
+            if length and lo < hi:
+                if kind == 'data':
+                    yield from self._iter_data(member, lo, hi)
+                else:
+                    yield self._segment_bytes(kind, member)[lo:hi]
+            start = max(start, seg_end)
+            index += 1
+
+
+def build_m3u(entries: List[Tuple[str, str]]) -> bytes:
+    """Build an extended M3U playlist from (arcname, display title) pairs"""
+    lines = ['#EXTM3U']
+    for arcname, display in entries:
+        lines.append(f'#EXTINF:-1,{display}')
+        lines.append(arcname)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range into [start, end); None means the whole body
+
+    Raises ValueError for unsatisfiable or malformed ranges.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError("Only single byte ranges are supported")
+    first, _, last = spec.strip().partition('-')
+    if first == '':
+        length = int(last)
+        if length <= 0:
+            raise ValueError("Invalid suffix range")
+        return max(0, size - length), size
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if start >= size or end <= start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size)
@@ -73,6 +73,20 @@ function App() {
             : download
         ));
         break;
+      case 'throttled':
+        setDownloads(prev => prev.map(download =>
+          download.id === data.download_id
+            ? { ...download, status: 'throttled', progress: 0, host: data.host, retry_at: data.retry_at }
+            : download
+        ));
+        break;
+      case 'requeued':
+        setDownloads(prev => prev.map(download =>
+          download.id === data.download_id
+            ? { ...download, status: 'pending', error: null }
+            : download
+        ));
+        break;
       case 'metadata_update':
         setDownloads(prev => prev.map(download =>
           download.id === data.download_id
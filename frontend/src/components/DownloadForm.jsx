@@ -106,7 +106,8 @@ const DownloadForm = ({ genres, onStartDownload }) => {
     const duplicates = await checkForDuplicates(validUrls, genre);
     setIsLoading(false);
 
-    if (duplicates && (duplicates.url_duplicate || duplicates.similar_songs.length > 0)) {
+    if (duplicates && (duplicates.url_duplicate || duplicates.similar_songs.length > 0 ||
+        (duplicates.audio_duplicates || []).length > 0)) {
       setDuplicateWarnings(duplicates);
       setShowDuplicateModal(true);
       return;
@@ -308,6 +309,25 @@ const DownloadForm = ({ genres, onStartDownload }) => {
               </div>
             )}
 
+            {(duplicateWarnings.audio_duplicates || []).length > 0 && (
+              <div className="mb-4">
+                <p className="font-medium text-gray-800 mb-2">Identical Audio Found:</p>
+                {duplicateWarnings.audio_duplicates.map((item, index) => (
+                  <div key={index} className="mb-3 p-3 bg-orange-50 border border-orange-200 rounded">
+                    <p className="font-medium text-gray-800">
+                      New: {item.new_artist} - {item.new_title}
+                    </p>
+                    <p className="text-sm text-gray-600 mb-2">Sounds the same as:</p>
+                    {item.matching_files.map((match, idx) => (
+                      <div key={idx} className="text-sm text-gray-700 ml-4">
+                        • {match.path} ({Math.round(match.similarity * 100)}% match)
+                      </div>
+                    ))}
+                  </div>
+                ))}
+              </div>
+            )}
+
             <div className="flex space-x-3 mt-6">
               <button
                 onClick={() => {
@@ -7,6 +7,8 @@ const DownloadQueue = ({ downloads }) => {
         return <Loader2 className="h-5 w-5 text-yellow-500 animate-spin" />;
       case 'downloading':
         return <Download className="h-5 w-5 text-blue-500 animate-pulse" />;
+      case 'throttled':
+        return <Clock className="h-5 w-5 text-orange-500" />;
       case 'completed':
         return <CheckCircle className="h-5 w-5 text-green-500" />;
       case 'error':
@@ -22,6 +24,8 @@ const DownloadQueue = ({ downloads }) => {
         return 'Pending';
       case 'downloading':
         return 'Downloading';
+      case 'throttled':
+        return 'Throttled';
       case 'completed':
         return 'Completed';
       case 'error':
@@ -37,6 +41,8 @@ const DownloadQueue = ({ downloads }) => {
         return 'bg-yellow-100 text-yellow-800';
       case 'downloading':
         return 'bg-blue-100 text-blue-800';
+      case 'throttled':
+        return 'bg-orange-100 text-orange-800';
       case 'completed':
         return 'bg-green-100 text-green-800';
       case 'error':
@@ -141,6 +147,24 @@ const DownloadQueue = ({ downloads }) => {
                   </div>
                 )}
 
+                {/* Throttled Message */}
+                {download.status === 'throttled' && (
+                  <div className="mt-3 p-3 bg-orange-50 border border-orange-200 rounded-md">
+                    <div className="flex">
+                      <Clock className="h-5 w-5 text-orange-400 flex-shrink-0" />
+                      <div className="ml-3">
+                        <h4 className="text-sm font-medium text-orange-800">
+                          Rate limited by {download.host}
+                        </h4>
+                        <p className="text-sm text-orange-700 mt-1">
+                          Retrying automatically
+                          {download.retry_at && ` at ${new Date(download.retry_at * 1000).toLocaleTimeString()}`}
+                        </p>
+                      </div>
+                    </div>
+                  </div>
+                )}
+
                 {/* Error Message */}
                 {download.status === 'error' && download.error && (
                   <div className="mt-3 p-3 bg-red-50 border border-red-200 rounded-md">
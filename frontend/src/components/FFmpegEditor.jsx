@@ -3,6 +3,9 @@ import { Play, Pause, Square, Scissors, Download, Upload, Volume2, VolumeX, Skip
 
 const FFmpegEditor = () => {
   const [audioFiles, setAudioFiles] = useState([]);
+  const [searchQuery, setSearchQuery] = useState('');
+  const [nextCursor, setNextCursor] = useState(null);
+  const [totalFiles, setTotalFiles] = useState(0);
   const [selectedFile, setSelectedFile] = useState(null);
   const [isPlaying, setIsPlaying] = useState(false);
   const [currentTime, setCurrentTime] = useState(0);
@@ -21,8 +24,10 @@ const FFmpegEditor = () => {
   const canvasRef = useRef(null);
 
   useEffect(() => {
-    loadAudioFiles();
-  }, []);
+    // Debounce typing so every keystroke does not hit the server
+    const timeout = setTimeout(() => loadAudioFiles(searchQuery), 250);
+    return () => clearTimeout(timeout);
+  }, [searchQuery]);
 
   useEffect(() => {
     if (selectedFile && audioRef.current) {
@@ -40,18 +45,32 @@ const FFmpegEditor = () => {
     }
   }, [selectedFile]);
 
-  // Update audio volume when volume state changes
+  // Update audio volume when volume state changes, normalized by the track's ReplayGain
   useEffect(() => {
     if (audioRef.current) {
-      audioRef.current.volume = volume;
+      audioRef.current.volume = volume * replayGainFactor(selectedFile);
     }
-  }, [volume]);
+  }, [volume, selectedFile]);
+
+  // The media element can only attenuate, so loud tracks are brought down to the
+  // reference level while quiet ones play as they are; the peak keeps it from clipping
+  const replayGainFactor = (file) => {
+    if (file?.track_gain == null) return 1;
+    const gain = Math.pow(10, file.track_gain / 20);
+    const peakLimit = file.track_peak ? 1 / file.track_peak : 1;
+    return Math.min(1, gain, peakLimit);
+  };
 
-  const loadAudioFiles = async () => {
+  const loadAudioFiles = async (query = '', cursor = null) => {
     try {
-      const response = await fetch('http://localhost:9000/audio-files');
+      const params = new URLSearchParams({ limit: '60' });
+      if (query.trim()) params.set('q', query.trim());
+      if (cursor) params.set('cursor', cursor);
+      const response = await fetch(`http://localhost:9000/search?${params}`);
       const data = await response.json();
-      setAudioFiles(data.files || []);
+      setAudioFiles(prev => (cursor ? [...prev, ...(data.files || [])] : (data.files || [])));
+      setNextCursor(data.next_cursor || null);
+      setTotalFiles(data.total || 0);
     } catch (error) {
       console.error('Failed to load audio files:', error);
     }
@@ -60,9 +79,11 @@ const FFmpegEditor = () => {
   const handleLoadedMetadata = () => {
     const audio = audioRef.current;
     if (audio) {
-      setDuration(audio.duration);
-      setEndTime(audio.duration);
-      setEndTimeInput(formatTimeInput(audio.duration));
+      // Prefer the exact duration from library analysis over the browser's estimate
+      const trackDuration = selectedFile?.duration || audio.duration;
+      setDuration(trackDuration);
+      setEndTime(trackDuration);
+      setEndTimeInput(formatTimeInput(trackDuration));
       drawWaveform();
     }
   };
@@ -348,11 +369,22 @@ const FFmpegEditor = () => {
       {/* File Selection */}
       <div className="card max-w-4xl mx-auto">
         <h3 className="text-2xl font-bold text-gray-900 mb-6">📁 Select Audio File</h3>
-        
+
+        <input
+          type="text"
+          value={searchQuery}
+          onChange={(e) => setSearchQuery(e.target.value)}
+          placeholder="Search by artist, title or genre..."
+          className="input-field mb-2"
+        />
+        <p className="text-sm text-gray-500 mb-6">{totalFiles} files</p>
+
         {audioFiles.length === 0 ? (
           <div className="text-center py-8">
             <Music className="mx-auto h-12 w-12 text-gray-400 mb-4" />
-            <p className="text-gray-600">No audio files found. Download some music first!</p>
+            <p className="text-gray-600">
+              {searchQuery ? 'No audio files match your search.' : 'No audio files found. Download some music first!'}
+            </p>
           </div>
         ) : (
           <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4">
@@ -377,6 +409,14 @@ const FFmpegEditor = () => {
             ))}
           </div>
         )}
+
+        {nextCursor && (
+          <div className="text-center mt-6">
+            <button onClick={() => loadAudioFiles(searchQuery, nextCursor)} className="btn-secondary">
+              Load more
+            </button>
+          </div>
+        )}
       </div>
 
       {/* Audio Player & Editor */}
@@ -388,7 +428,6 @@ const FFmpegEditor = () => {
           <audio
             ref={audioRef}
             src={`http://localhost:9000/audio/${encodeURIComponent(selectedFile.path)}`}
-            onVolumeChange={(e) => setVolume(e.target.volume)}
           />
 
           {/* Waveform Display */}
@@ -490,6 +529,11 @@ const FFmpegEditor = () => {
                 <span className="text-sm font-mono text-gray-700 w-12 text-center">
                   {Math.round(volume * 100)}%
                 </span>
+                {selectedFile.track_gain != null && (
+                  <span className="text-xs text-gray-500" title="ReplayGain applied to playback">
+                    RG {selectedFile.track_gain > 0 ? '+' : ''}{selectedFile.track_gain.toFixed(1)} dB
+                  </span>
+                )}
               </div>
             </div>
 
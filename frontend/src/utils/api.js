@@ -26,6 +26,12 @@ export const downloadAPI = {
     return response.data;
   },
 
+  // Get per-host admission limits and backoff state
+  getRateLimits: async () => {
+    const response = await api.get('/rate-limits');
+    return response.data;
+  },
+
   // Get available genres
   getGenres: async () => {
     const response = await api.get('/genres');